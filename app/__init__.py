@@ -13,7 +13,8 @@ storage = MemoryStorage()
 i18n = I18n(path=locales_dir, default_locale='en', domain='bot')
 
 router = Router()
-DBI18nMiddleware(i18n=i18n).setup(router)
+i18n_middleware = DBI18nMiddleware(i18n=i18n)
+i18n_middleware.setup(router)
 
 dp = Dispatcher(storage=storage)
 dp.include_router(router)
@@ -0,0 +1,72 @@
+import sys
+import asyncio
+import resource
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from app import config
+from app.utils import media
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def make_original(path, length: int):
+    # a tone over pink noise, closer to music than silence for the lossless encoders
+    await media.run_ffmpeg('-loglevel', 'error', '-y',
+                           '-f', 'lavfi', '-i', f'sine=frequency=440:duration={length}',
+                           '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.3:duration={length}',
+                           '-filter_complex', 'amix=inputs=2', '-ac', '2', '-ar', 44100,
+                           '-c:a', 'libmp3lame', '-q:a', '2', path)
+
+
+async def separate(file_id, parts_dir, results_dirs, parts: int):
+    # stand-in for lalal.ai, not timed: it sends back mp3 tracks of every part whatever format was uploaded
+    for results_dir in results_dirs:
+        for part in range(parts):
+            await media.run_ffmpeg('-loglevel', 'error', '-y', '-i', parts_dir / media.original_part_name(file_id, part),
+                                   '-c:a', 'libmp3lame', '-q:a', '2', results_dir / media.part_name(file_id, part))
+
+
+async def job(file_id: str, original, tmp: Path, part_format: str):
+    """
+    Local work of one job: split into parts of the format, then merge of the separated parts
+
+    :return: CPU and wall seconds of the split, of the merge and bytes of the parts
+    """
+    config.PART_FORMAT = part_format
+    parts_dir, stem_dir, no_stem_dir = (tmp / name for name in ('parts', 'stem', 'no_stem'))
+    for directory in (parts_dir, stem_dir, no_stem_dir):
+        directory.mkdir(exist_ok=True)
+    cpu, start = children_cpu(), perf_counter()
+    parts, _ = await media.split(file_id, original, parts_dir)
+    split_cpu, split_wall = children_cpu() - cpu, perf_counter() - start
+    size = sum((parts_dir / media.original_part_name(file_id, part)).stat().st_size
+               for part in range(parts))
+    await separate(file_id, parts_dir, (stem_dir, no_stem_dir), parts)
+    files = [media.part_name(file_id, part) for part in range(parts)]
+    cpu, start = children_cpu(), perf_counter()
+    await media.merge(stem_dir, no_stem_dir, files, 'benchmark', tmp / 'stem.mp3', tmp / 'no_stem.mp3')
+    merge_cpu, merge_wall = children_cpu() - cpu, perf_counter() - start
+    return split_cpu, split_wall, merge_cpu, merge_wall, size
+
+
+async def main(length: int = 300, repeat: int = 3):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        original = tmp / 'original.mp3'
+        await make_original(original, length)
+        print(f'{length}s job, split and merge, best of {repeat} runs by wall time')
+        for part_format in media.PART_FORMATS:
+            runs = [await job('benchmark', original, tmp, part_format) for _ in range(repeat)]
+            split_cpu, split_wall, merge_cpu, merge_wall, size = min(runs, key=lambda run: run[1] + run[3])
+            print(f'{part_format:>5}: split cpu {split_cpu:.2f}s wall {split_wall:.2f}s, '
+                  f'merge cpu {merge_cpu:.2f}s wall {merge_wall:.2f}s, '
+                  f'job cpu {split_cpu + merge_cpu:.2f}s wall {split_wall + merge_wall:.2f}s, '
+                  f'parts {size / 1024 / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
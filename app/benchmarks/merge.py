@@ -0,0 +1,76 @@
+import sys
+import asyncio
+import tempfile
+from time import perf_counter
+from pathlib import Path
+from app import config
+from app.utils import media, overlap
+
+RATE = 44100
+TOLERANCE = 1e-4
+
+
+async def make_parts(folder: Path, count: int, frequency: int):
+    folder.mkdir()
+    files = []
+    for part in range(count):
+        length = 60 if part < count - 1 else 20
+        files.append(f'{part}.mp3')
+        await media.run_ffmpeg('-loglevel', 'error', '-y', '-f', 'lavfi',
+                               '-i', f'sine=frequency={frequency + part * 55}:sample_rate={RATE}:duration={length}',
+                               '-ac', '2', '-c:a', 'libmp3lame', '-q:a', '2', folder / files[-1])
+    return files
+
+
+async def decode(path) -> 'overlap.np.ndarray':
+    out = await media.run_ffmpeg('-loglevel', 'error', '-i', path, '-f', 'f32le', '-ar', RATE, '-ac', 2, 'pipe:1')
+    return overlap.np.frombuffer(out, dtype=overlap.np.float32).reshape(-1, 2)
+
+
+async def accuracy(folder: Path, files) -> float:
+    """
+    :return: max absolute difference between the acrossfade chain and numpy overlap-add, before mp3 encoding
+    """
+    args = [item for filename in files for item in ('-i', folder / filename)]
+    graph = ';'.join(media.crossfade_chain(0, len(files), 'out'))
+    out = await media.run_ffmpeg('-loglevel', 'error', *args, '-filter_complex', graph, '-map', '[out]',
+                                 '-f', 'f32le', '-ar', RATE, '-ac', 2, 'pipe:1')
+    expected = overlap.np.frombuffer(out, dtype=overlap.np.float32).reshape(-1, 2)
+    parts = [await decode(folder / filename) for filename in files]
+    actual = overlap.np.zeros((overlap.merged_length([len(part) for part in parts], RATE), 2), dtype=overlap.np.float32)
+    overlap.overlap_add(parts, RATE, actual)
+    if len(actual) != len(expected):
+        raise AssertionError(f'length mismatch: numpy {len(actual)}, ffmpeg {len(expected)}')
+    return float(overlap.np.abs(actual - expected).max())
+
+
+async def timing(engine: str, tmp: Path, files, repeat: int) -> list:
+    config.MERGE_ENGINE = engine
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        await media.merge(tmp / 'stem', tmp / 'no_stem', files, 'benchmark',
+                          tmp / f'{engine}_stem.mp3', tmp / f'{engine}_no_stem.mp3')
+        times.append(perf_counter() - start)
+    return times
+
+
+async def main(count: int = 6, repeat: int = 3):
+    if overlap.np is None:
+        sys.exit('numpy is not installed')
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        files = await make_parts(tmp / 'stem', count, 220)
+        await make_parts(tmp / 'no_stem', count, 330)
+
+        error = await accuracy(tmp / 'stem', files)
+        print(f'max abs error {error:.2e} (tolerance {TOLERANCE:.0e})')
+        for engine in ('ffmpeg', 'numpy'):
+            times = await timing(engine, tmp, files, repeat)
+            print(f'{engine:>6}: best {min(times):.2f}s, mean {sum(times) / len(times):.2f}s over {repeat} runs')
+    if error > TOLERANCE:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -1,17 +1,20 @@
 import logging
-from asyncio import get_event_loop
+from asyncio import get_event_loop, create_task
 from aiohttp import web
 from aiogram import types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.utils.i18n import gettext as _
 from aiogram.exceptions import TelegramAPIError
 
-from app import config, bot, router, dp
-from app.utils.database_connection import DatabaseConnection
-from app.utils.utils import get_callback, CallbackFuncs, ButtonSet, download_file
+from app import config, bot, router, dp, i18n_middleware
+from app.misc import files_dir
+from app.utils import stats
+from app.utils.database_connection import DatabaseConnection, close_pool
+from app.utils.utils import get_callback, CallbackFuncs, ButtonSet, download_file, send_result
+from app.utils.result_cache import Result
 from app.utils.middlewares import DBI18nMiddleware
 from lalalai.audio import Audio
 
@@ -47,6 +50,28 @@ async def message_handler(message: types.Message, state: FSMContext):
     await send_menu(message, state)
 
 
+@router.message(Command('resend'), F.chat.id == config.BOT_ADMIN)
+async def message_handler(message: types.Message, command: CommandObject):
+    # admin only: send a delivered result to its user again by telegram file ids, nothing is uploaded
+    if not command.args or not command.args.strip().isdigit():
+        return await message.answer('Usage: /resend <audiofile id>')
+    file_id = int(command.args)
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('SELECT users.user_id, a.title, a.duration, a.stem_file_id, a.no_stem_file_id '
+                             'FROM audiofiles AS a '
+                             'INNER JOIN users ON users.id = a.user_id '
+                             'WHERE a.id=%s',
+                             [file_id])
+        row = await cursor.fetchone()
+    if row is None or row[3] is None or row[4] is None:
+        return await message.answer(f'Audio file {file_id} has no delivered result')
+    user_id, title, duration, stem_file_id, no_stem_file_id = row
+    result = Result(None, None, duration, stem_file_id, no_stem_file_id)
+    sent = await send_result(user_id, title, result)
+    await message.answer(f'Audio file {file_id} resent to {user_id}' if sent else f'Resending audio file {file_id} failed')
+
+
 @router.message(F.text)
 async def message_handler(message: types.Message, state: FSMContext):
     await send_menu(message, state)
@@ -58,8 +83,8 @@ async def send_menu(message: types.Message, state: FSMContext):
 
 
 @router.message(F.audio, Form.file)
-async def message_handler(message: types.Message, state: FSMContext):
-    await set_audiofile(message, state)
+async def message_handler(message: types.Message, state: FSMContext, i18n_middleware: DBI18nMiddleware):
+    await set_audiofile(message, state, i18n_middleware)
 
 
 @router.callback_query(Form.stem)
@@ -99,31 +124,41 @@ async def set_level(message, data, state):
     await message.edit_text(_('send_audiofile'))
 
 
-async def set_audiofile(message, state):
+async def set_audiofile(message, state, i18n_middleware):
     if message.audio.file_size > config.MAX_FILE_SIZE:
         return await message.reply(_('file_too_big'))
     if message.audio.duration > config.MAX_AUDIO_DURATION:
         return await message.reply(_('file_too_long'))
     if message.audio.duration < config.MIN_AUDIO_DURATION:
         return await message.reply(_('file_too_short'))
-    with DatabaseConnection() as db:
+    user_id = await i18n_middleware.get_user_id(message.chat.id)
+    async with DatabaseConnection() as db:
         conn, cursor = db
-        cursor.execute('SELECT COUNT(a.id) '
-                       'FROM audiofiles AS a '
-                       'INNER JOIN users ON users.id = a.user_id '
-                       'WHERE a.status IN (\'init\', \'await\') AND users.user_id=%s',
-                       [message.chat.id])
-        user_processes = cursor.fetchone()[0]
+        await cursor.execute('SELECT COUNT(a.id) '
+                             'FROM audiofiles AS a '
+                             'WHERE a.status IN (\'init\', \'await\', \'processing\') AND a.user_id=%s',
+                             [user_id])
+        user_processes = (await cursor.fetchone())[0]
     if user_processes >= config.MAX_USER_PROCESSES:
         return await message.answer(_('max_processes'))
     await state.set_state(Form.processing)
     await message.answer(_('processing'))
     try:
-        await download_file(message.chat.id, message.audio, await state.get_data())
+        await download_file(message.chat.id, user_id, message.audio, await state.get_data())
     except TelegramAPIError:
         await message.answer(_('error_processing'))
 
 
+# the locale cache lives in the bot process, its counters go to a stats file of their own
+stats.register('locale_cache', i18n_middleware.users.stats)
+stats_task = None
+
+
+async def dump_stats():
+    global stats_task
+    stats_task = create_task(stats.dump_periodically(files_dir / 'bot_stats.json', config.BOT_STATS_INTERVAL))
+
+
 async def on_startup():
     await bot.set_webhook(config.WEBHOOK_URL)
     info = await bot.get_webhook_info()
@@ -132,15 +167,19 @@ async def on_startup():
 
 async def on_shutdown():
     await bot.delete_webhook()
+    await close_pool()
 
 
 def start_pooling():
+    dp.startup.register(dump_stats)
+    dp.shutdown.register(close_pool)
     loop = get_event_loop()
     loop.run_until_complete(dp.start_polling(bot, skip_updates=True))
 
 
 def start_webhook():
     app = web.Application()
+    dp.startup.register(dump_stats)
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
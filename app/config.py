@@ -11,6 +11,30 @@ MAX_FILE_SIZE = env.int('MAX_FILE_SIZE', default=20 * 1024 * 1024)  # 20 MB
 MAX_AUDIO_DURATION = env.int('MAX_AUDIO_DURATION', default=6 * 60)  # 6 minutes
 MIN_AUDIO_DURATION = env.int('MIN_AUDIO_DURATION', default=3)  # 3 seconds
 
+UPDATER_WORKERS = env.int('UPDATER_WORKERS', default=2)
+UPDATER_QUEUE_SIZE = env.int('UPDATER_QUEUE_SIZE', default=10)
+UPDATER_POLL_INTERVAL = env.int('UPDATER_POLL_INTERVAL', default=60)  # 1 minute, fallback for missed notifications
+UPDATER_SOCKET = env.str('UPDATER_SOCKET', default='')  # files/updater.sock
+UPDATER_ID = env.str('UPDATER_ID', default='')  # hostname:pid
+UPDATER_LEASE = env.int('UPDATER_LEASE', default=2 * 60)  # 2 minutes, renewed every third of it
+PART_ATTEMPTS = env.int('PART_ATTEMPTS', default=3)  # per part within one run of a job
+JOB_ATTEMPTS = env.int('JOB_ATTEMPTS', default=3)  # runs of a job before it fails, at most PART_ATTEMPTS * JOB_ATTEMPTS per part
+JOB_RETRY_DELAY = env.int('JOB_RETRY_DELAY', default=30)  # seconds before a failed job is claimed again, doubled per attempt
+UPDATER_STATS_INTERVAL = env.int('UPDATER_STATS_INTERVAL', default=60)  # 1 minute, files/updater_stats.json
+BOT_STATS_INTERVAL = env.int('BOT_STATS_INTERVAL', default=60)  # 1 minute, files/bot_stats.json
+DELIVERY_WORKERS = env.int('DELIVERY_WORKERS', default=2)  # telegram uploads, apart from the processing workers
+DELIVERY_QUEUE_SIZE = env.int('DELIVERY_QUEUE_SIZE', default=10)
+MEDIA_WORKERS = env.int('MEDIA_WORKERS', default=0)  # 0 - number of cores
+WORKSPACE_MEMORY_DIR = env.str('WORKSPACE_MEMORY_DIR', default='')  # tmpfs directory for job files, e.g. /dev/shm/audiosplitter
+WORKSPACE_MEMORY_BUDGET = env.int('WORKSPACE_MEMORY_BUDGET', default=512 * 1024 * 1024)  # 512 MB, jobs beyond it go to disk
+WORKSPACE_HIGH_WATERMARK = env.int('WORKSPACE_HIGH_WATERMARK', default=8 * 1024 ** 3)  # 8 GB, reclaim and pause intake
+WORKSPACE_LOW_WATERMARK = env.int('WORKSPACE_LOW_WATERMARK', default=6 * 1024 ** 3)  # 6 GB, reclaim down to it
+WORKSPACE_ORPHAN_AGE = env.int('WORKSPACE_ORPHAN_AGE', default=60 * 60)  # 1 hour, untouched directories of no active job
+WORKSPACE_GC_INTERVAL = env.int('WORKSPACE_GC_INTERVAL', default=5 * 60)  # 5 minutes
+SPLIT_PIPELINE = env.bool('SPLIT_PIPELINE', default=False)  # cut parts one by one and upload each at once, decodes more
+PART_FORMAT = env.str('PART_FORMAT', default='mp3')  # mp3, flac or wav, format of the uploaded parts
+MERGE_ENGINE = env.str('MERGE_ENGINE', default='ffmpeg')  # ffmpeg or numpy (needs numpy installed)
+
 TG_TOKEN = env.str('TG_TOKEN')
 WEBAPP_HOST = env.str('WEBAPP_HOST', default='0.0.0.0')
 WEBAPP_PORT = env.int('WEBAPP_PORT', default=8080)
@@ -26,9 +50,50 @@ MYSQL_PORT = env.int('MYSQL_PORT', default=3306)
 MYSQL_PASSWORD = env.str('MYSQL_PASSWORD', default='')
 MYSQL_USER = env.str('MYSQL_USER', default='')
 MYSQL_DB = env.str('MYSQL_DB', default='')
+MYSQL_POOL_MIN = env.int('MYSQL_POOL_MIN', default=1)
+MYSQL_POOL_MAX = env.int('MYSQL_POOL_MAX', default=10)
+MYSQL_POOL_RECYCLE = env.int('MYSQL_POOL_RECYCLE', default=3600)  # 1 hour
+MYSQL_POOL_PING_INTERVAL = env.int('MYSQL_POOL_PING_INTERVAL', default=60)  # 1 minute
+MYSQL_QUERY_TIMEOUT = env.int('MYSQL_QUERY_TIMEOUT', default=10)  # 10 seconds
 
 BOT_ADMIN = env.int('BOT_ADMIN', default=0)
 
+RESULT_CACHE_MAX_BYTES = env.int('RESULT_CACHE_MAX_BYTES', default=2 * 1024 * 1024 * 1024)  # 2 GB
+
+LOCALE_CACHE_SIZE = env.int('LOCALE_CACHE_SIZE', default=10000)
+LOCALE_CACHE_TTL = env.int('LOCALE_CACHE_TTL', default=24 * 60 * 60)  # 1 day
+
+POLL_MIN_INTERVAL = env.float('POLL_MIN_INTERVAL', default=1)  # seconds
+POLL_MAX_INTERVAL = env.float('POLL_MAX_INTERVAL', default=10)  # seconds
+POLL_EXPECTED_TIME = env.float('POLL_EXPECTED_TIME', default=20)  # seconds, until learned from finished parts
+POLL_MAX_AGE = env.float('POLL_MAX_AGE', default=30 * 60)  # 30 minutes, a part not ready by then fails
+CAPTCHA_EXPECTED_TIME = env.float('CAPTCHA_EXPECTED_TIME', default=10)  # seconds, until learned from solved tokens
+
+BREAKER_FAILURES = env.int('BREAKER_FAILURES', default=5)  # consecutive failures
+BREAKER_ERROR_RATE = env.float('BREAKER_ERROR_RATE', default=0.5)
+BREAKER_WINDOW = env.int('BREAKER_WINDOW', default=60)  # 1 minute
+BREAKER_RESET_TIMEOUT = env.int('BREAKER_RESET_TIMEOUT', default=60)  # 1 minute until a probe call
+
+UPLOAD_PART_SIZE = env.int('UPLOAD_PART_SIZE', default=5 * 1024 * 1024)  # 5 MB, larger parts upload in parallel
+UPLOAD_ATTEMPTS = env.int('UPLOAD_ATTEMPTS', default=3)  # per chunk
+DOWNLOAD_BUFFER_SIZE = env.int('DOWNLOAD_BUFFER_SIZE', default=1024 * 1024)  # 1 MB per write
+DOWNLOAD_ATTEMPTS = env.int('DOWNLOAD_ATTEMPTS', default=3)  # per file, resumed where it stopped
+HTTP_API_TIMEOUT = env.int('HTTP_API_TIMEOUT', default=10)  # total seconds of an api call, also the connect timeout
+HTTP_TRANSFER_READ_TIMEOUT = env.int('HTTP_TRANSFER_READ_TIMEOUT', default=30)  # seconds without data on an upload or download
+HTTP_POOL_LIMIT = env.int('HTTP_POOL_LIMIT', default=100)
+HTTP_POOL_LIMIT_PER_HOST = env.int('HTTP_POOL_LIMIT_PER_HOST', default=30)
+HTTP_DNS_TTL = env.int('HTTP_DNS_TTL', default=5 * 60)  # 5 minutes
+HTTP_KEEPALIVE = env.float('HTTP_KEEPALIVE', default=30)  # seconds an idle connection is kept
+LALALAI_RATE = env.float('LALALAI_RATE', default=5)  # requests per second
+LALALAI_BURST = env.int('LALALAI_BURST', default=10)
+LALALAI_MAX_CONCURRENCY = env.int('LALALAI_MAX_CONCURRENCY', default=16)
+
 CAPSOLVER_API_KEY = env.str('CAPSOLVER_API_KEY', default='')
+CAPSOLVER_RATE = env.float('CAPSOLVER_RATE', default=5)  # requests per second
+CAPSOLVER_BURST = env.int('CAPSOLVER_BURST', default=10)
+CAPSOLVER_MAX_CONCURRENCY = env.int('CAPSOLVER_MAX_CONCURRENCY', default=16)
+CAPTCHA_POOL_SIZE = env.int('CAPTCHA_POOL_SIZE', default=0)  # tokens kept ready while idle, each re-solved every TTL
+CAPTCHA_POOL_MAX = env.int('CAPTCHA_POOL_MAX', default=8)
+CAPTCHA_TOKEN_TTL = env.int('CAPTCHA_TOKEN_TTL', default=4 * 60)  # 4 minutes, turnstile tokens live 5
 SERVICE_TURNSTILE_URL = env.str('SERVICE_TURNSTILE_URL', default='')
 SERVICE_TURNSTILE_TOKEN = env.str('SERVICE_TURNSTILE_TOKEN', default='')
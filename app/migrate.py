@@ -0,0 +1,70 @@
+import sys
+import logging
+from app.misc import migrations_dir
+from app.utils.database_connection import DatabaseConnection
+
+
+# hot queries and the table each one must reach through an index
+HOT_QUERIES = (
+    ('users', 'SELECT id, locale FROM users WHERE user_id=%s', [1]),
+    ('audiofiles', 'SELECT COUNT(a.id) FROM audiofiles AS a '
+                   'WHERE a.status IN (\'init\', \'await\', \'processing\') AND a.user_id=%s', [1]),
+    ('audiofiles', 'UPDATE audiofiles SET status=\'processing\', claimed_by=%s, claim_token=%s, lease_until=NOW() '
+                   'WHERE (status=\'await\' AND parent_id IS NULL '
+                   'AND (lease_until IS NULL OR lease_until < NOW())) '
+                   'OR (status=\'processing\' AND lease_until < NOW()) '
+                   'ORDER BY id LIMIT %s', ['', '', 1]),
+    ('audiofiles', 'SELECT a.id FROM audiofiles AS a WHERE status IN (\'error\', \'complete\')', []),
+    ('audiofiles', 'SELECT id FROM audiofiles WHERE file_unique_id=%s AND stem=%s AND level=%s AND parent_id IS NULL '
+                   'AND status IN (\'init\', \'await\', \'processing\') ORDER BY id LIMIT 1', ['', '', 1]),
+    ('result_cache', 'SELECT id, duration FROM result_cache WHERE file_unique_id=%s AND stem=%s AND level=%s '
+                     'ORDER BY id DESC LIMIT 1', ['', '', 1]),
+    ('result_cache', 'SELECT id, duration FROM result_cache WHERE content_hash=%s AND stem=%s AND level=%s '
+                     'ORDER BY id DESC LIMIT 1', ['', '', 1]),
+)
+
+
+def split_statements(sql: str):
+    lines = (line for line in sql.splitlines() if not line.lstrip().startswith('--'))
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+def migrate():
+    with DatabaseConnection() as db:
+        conn, cursor = db
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_migrations ('
+                       'version varchar(64) NOT NULL PRIMARY KEY, '
+                       'applied_at timestamp DEFAULT current_timestamp() NOT NULL)')
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cursor.fetchall()}
+        for path in sorted(migrations_dir.glob('*.sql')):
+            if path.stem in applied:
+                continue
+            logging.warning(f'Applying migration {path.stem}')
+            for statement in split_statements(path.read_text()):
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (version) VALUES (%s)', [path.stem])
+            conn.commit()
+
+
+def explain() -> bool:
+    ok = True
+    with DatabaseConnection() as db:
+        conn, cursor = db
+        for table, query, args in HOT_QUERIES:
+            cursor.execute(f'EXPLAIN {query}', args)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            plans = [(row['type'], row['key']) for row in rows if row['table'] in (table, 'a')]
+            # type 'index' reads the whole index, as much a scan as 'ALL'
+            used = bool(plans) and all(key and access not in ('ALL', 'index') for access, key in plans)
+            ok &= used
+            logging.warning(f'{"OK  " if used else "SCAN"} {plans} {query}')
+    return ok
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    migrate()
+    if '--explain' in sys.argv[1:] and not explain():
+        sys.exit(1)
@@ -4,6 +4,7 @@ from pathlib import Path
 
 app_dir: Path = Path(__file__).parent.parent
 locales_dir = app_dir / 'locales'
+migrations_dir = app_dir / 'migrations'
 files_dir = app_dir / 'files'
 
 if os.name == 'nt':
@@ -0,0 +1,41 @@
+from app.utils.database_connection import DatabaseConnection
+
+
+# job stages in order, a job resumes after the last stage it reached
+STAGES = (None, 'split', 'separated', 'merged', 'delivered')
+
+
+def reached(stage, target) -> bool:
+    return STAGES.index(stage) >= STAGES.index(target)
+
+
+async def set_stage(file_id, stage, parts=None, content_hash=None):
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('UPDATE audiofiles SET stage=%s, parts=COALESCE(%s, parts), '
+                             'content_hash=COALESCE(%s, content_hash) WHERE id=%s',
+                             [stage, parts, content_hash, file_id])
+
+
+async def load_parts(file_id) -> dict:
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('SELECT part, state, lalal_id, attempts FROM audiofile_parts WHERE audiofile_id=%s',
+                             [file_id])
+        return {part: (state, lalal_id, attempts) for part, state, lalal_id, attempts in await cursor.fetchall()}
+
+
+async def set_part(file_id, part, state, lalal_id=None, error=None, failed=False):
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('INSERT INTO audiofile_parts (audiofile_id, part, state, lalal_id, attempts, error) '
+                             'VALUES (%s, %s, %s, %s, %s, %s) '
+                             'ON DUPLICATE KEY UPDATE state=VALUES(state), lalal_id=COALESCE(VALUES(lalal_id), lalal_id), '
+                             'attempts=attempts + VALUES(attempts), error=VALUES(error)',
+                             [file_id, part, state, lalal_id, int(failed), error and str(error)[:256]])
+
+
+async def reset_parts(file_id):
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('DELETE FROM audiofile_parts WHERE audiofile_id=%s', [file_id])
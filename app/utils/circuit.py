@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing service
+
+    Opens after `failures` consecutive failures or when the error rate over `window` seconds
+    reaches `error_rate`. Callers wait while it is open, after `reset_timeout` a single probe call
+    is let through and its outcome closes or reopens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failures: int, error_rate: float, window: float, reset_timeout: float,
+                 min_calls: int = 10):
+        self.name = name
+        self.failures = failures
+        self.error_rate = error_rate
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.min_calls = min_calls
+        self._state = self.CLOSED
+        self.opened_at = 0.0
+        self.consecutive = 0
+        self.results = deque()
+        self.probing = False
+        self.changed = asyncio.Event()
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            logging.warning(f'Circuit {self.name} {state}')
+        self._state = state
+        self.consecutive = 0
+        self.results.clear()
+        if state == self.OPEN:
+            self.opened_at = monotonic()
+            self.opened += 1
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def acquire(self) -> bool:
+        """
+        Wait until a call is allowed
+
+        :return: whether the call is the half-open probe
+        """
+        while True:
+            state = self.state
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            timeout = self.reset_timeout - (monotonic() - self.opened_at) if state == self.OPEN else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def release_probe(self):
+        # a probe that never made its call, the next waiting caller becomes the probe
+        self.probing = False
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def record(self, ok: bool, probe: bool = False):
+        if probe:
+            self.probing = False
+            self._set_state(self.CLOSED if ok else self.OPEN)
+            return
+        if self._state != self.CLOSED:
+            return
+        now = monotonic()
+        self.results.append((now, ok))
+        while self.results and self.results[0][0] < now - self.window:
+            self.results.popleft()
+        self.consecutive = 0 if ok else self.consecutive + 1
+        errors = sum(not result for _, result in self.results)
+        if self.consecutive >= self.failures or \
+                (len(self.results) >= self.min_calls and errors / len(self.results) >= self.error_rate):
+            self._set_state(self.OPEN)
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'consecutive_failures': self.consecutive, 'opened': self.opened}
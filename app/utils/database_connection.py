@@ -1,13 +1,81 @@
+import asyncio
+import aiomysql
 import mysql.connector
 from app.config import *
 
 
+pool: aiomysql.Pool | None = None
+pool_lock = asyncio.Lock()
+
+
+async def get_pool() -> aiomysql.Pool:
+    global pool
+    async with pool_lock:
+        if pool is None:
+            pool = await aiomysql.create_pool(
+                host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER, password=MYSQL_PASSWORD, db=MYSQL_DB,
+                minsize=MYSQL_POOL_MIN, maxsize=MYSQL_POOL_MAX, pool_recycle=MYSQL_POOL_RECYCLE,
+                connect_timeout=MYSQL_QUERY_TIMEOUT, autocommit=True)
+    return pool
+
+
+async def close_pool():
+    global pool
+    async with pool_lock:
+        if pool is not None:
+            pool.close()
+            await pool.wait_closed()
+            pool = None
+
+
+class Cursor:
+    def __init__(self, cursor: aiomysql.Cursor):
+        self.cursor = cursor
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    async def execute(self, query, args=None):
+        return await asyncio.wait_for(self.cursor.execute(query, args), MYSQL_QUERY_TIMEOUT)
+
+    async def fetchone(self):
+        return await self.cursor.fetchone()
+
+    async def fetchall(self):
+        return await self.cursor.fetchall()
+
+
 class DatabaseConnection:
     def __enter__(self):
-        self.conn = mysql.connector.connect(host=MYSQL_HOST, user=MYSQL_USER, passwd=MYSQL_PASSWORD, database=MYSQL_DB)
+        self.conn = mysql.connector.connect(host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER, passwd=MYSQL_PASSWORD, database=MYSQL_DB)
         self.cursor = self.conn.cursor(buffered=True)
         return self.conn, self.cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.cursor.close()
         self.conn.close()
+
+    async def __aenter__(self):
+        self.pool = await get_pool()
+        self.conn = await self.pool.acquire()
+        try:
+            # health check for connections that have been idle long enough to be dropped by the server
+            if asyncio.get_running_loop().time() - self.conn.last_usage > MYSQL_POOL_PING_INTERVAL:
+                await asyncio.wait_for(self.conn.ping(reconnect=True), MYSQL_QUERY_TIMEOUT)
+            self.cursor = await self.conn.cursor()
+        except BaseException:
+            self.conn.close()
+            self.pool.release(self.conn)
+            raise
+        return self.conn, Cursor(self.cursor)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.cursor.close()
+        if isinstance(exc_val, (asyncio.TimeoutError, asyncio.CancelledError)):
+            self.conn.close()  # a query may still be running on it
+        self.pool.release(self.conn)
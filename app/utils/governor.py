@@ -0,0 +1,121 @@
+import asyncio
+from time import monotonic
+from contextlib import asynccontextmanager
+from app.utils.circuit import CircuitBreaker
+from app.utils.polling import DurationEstimate
+
+
+class Call:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.ok = True
+        self.start = monotonic()
+
+
+class Governor:
+    """
+    Token bucket for the request rate plus an AIMD concurrency limit for one remote service
+
+    The limit halves on errors or latency spikes and grows by about one per window of healthy calls.
+    Call outcomes also feed the optional circuit breaker, which holds calls back while the service is down.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, min_limit: int, max_limit: int,
+                 initial_limit: int = 4, latency_factor: float = 3, breaker: CircuitBreaker = None):
+        self.name = name
+        self.breaker = breaker
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = monotonic()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(max_limit, initial_limit)))
+        self.latency_factor = latency_factor
+        self.latency = {}
+        self.decreased = 0.0
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.requests = 0
+        self.errors = 0
+        self.spikes = 0
+        self.waited = 0.0
+
+    async def _take_token(self):
+        while True:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        start = monotonic()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        await self._take_token()
+        self.waited += monotonic() - start
+
+    async def release(self, call: Call):
+        now = monotonic()
+        elapsed = now - call.start
+        baseline = self.latency.get(call.kind)
+        spike = call.ok and baseline is not None and baseline.samples > 5 \
+            and elapsed > baseline.value * self.latency_factor
+        self.requests += 1
+        if not call.ok or spike:
+            self.errors += not call.ok
+            self.spikes += spike
+            # one decrease per burst of failures
+            if now - self.decreased > 1:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.decreased = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.latency.setdefault(call.kind, DurationEstimate(elapsed)).update(elapsed)
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, kind: str = 'request'):
+        probe = await self.breaker.acquire() if self.breaker else False
+        try:
+            await self.acquire()
+        except BaseException:
+            if probe:
+                self.breaker.release_probe()
+            raise
+        call = Call(kind)
+        cancelled = False
+        try:
+            yield call
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except BaseException:
+            call.ok = False
+            raise
+        finally:
+            await self.release(call)
+            if self.breaker and cancelled:
+                if probe:
+                    self.breaker.release_probe()
+            elif self.breaker:
+                self.breaker.record(call.ok, probe)
+
+    def stats(self) -> dict:
+        return {
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'tokens': round(self.tokens, 2),
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_spikes': self.spikes,
+            'latency': {kind: round(estimate.value, 3) for kind, estimate in self.latency.items()},
+            'wait_time': round(self.waited, 3),
+            **({'circuit': self.breaker.stats()} if self.breaker else {}),
+        }
@@ -0,0 +1,56 @@
+import logging
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from app import config
+from app.misc import base_headers
+
+
+# timeout profiles: api calls answer small json quickly, transfers only need the connection to keep moving
+API_TIMEOUT = ClientTimeout(total=config.HTTP_API_TIMEOUT)
+TRANSFER_TIMEOUT = ClientTimeout(total=None, connect=config.HTTP_API_TIMEOUT, sock_read=config.HTTP_TRANSFER_READ_TIMEOUT)
+
+session: ClientSession | None = None
+
+# connection reuse of the shared session, in the updater stats
+connection_stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0, 'dns_hits': 0, 'dns_misses': 0}
+
+
+def _count(key: str):
+    async def handler(_session, _context, _params):
+        connection_stats[key] += 1
+    return handler
+
+
+def trace_config() -> TraceConfig:
+    trace = TraceConfig()
+    trace.on_request_start.append(_count('requests'))
+    trace.on_connection_create_end.append(_count('new_connections'))
+    trace.on_connection_reuseconn.append(_count('reused_connections'))
+    trace.on_dns_cache_hit.append(_count('dns_hits'))
+    trace.on_dns_cache_miss.append(_count('dns_misses'))
+    return trace
+
+
+def get_session() -> ClientSession:
+    """
+    Long-lived session of the process, its connector keeps connections alive per host and caches dns
+    """
+    global session
+    if session is None or session.closed:
+        connector = TCPConnector(limit=config.HTTP_POOL_LIMIT, limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+                                 ttl_dns_cache=config.HTTP_DNS_TTL, keepalive_timeout=config.HTTP_KEEPALIVE)
+        session = ClientSession(headers=base_headers, connector=connector, timeout=API_TIMEOUT,
+                                trace_configs=[trace_config()])
+        logging.debug('HTTP session created')
+    return session
+
+
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
+
+
+def stats() -> dict:
+    reused, new = connection_stats['reused_connections'], connection_stats['new_connections']
+    return {**connection_stats, 'reuse_ratio': round(reused / ((reused + new) or 1), 3)}
@@ -0,0 +1,295 @@
+import os
+import json
+import asyncio
+import logging
+import tempfile
+import ffmpeg
+from fractions import Fraction
+from pathlib import Path
+from app import config
+from app.misc import ffmpeg_cmd, ffprobe_cmd
+from app.utils import overlap
+
+
+# ffmpeg and ffprobe run as subprocesses so the event loop keeps serving network work,
+# the semaphore keeps the number of concurrent transcodes at the number of cores
+semaphore = asyncio.Semaphore(config.MEDIA_WORKERS or os.cpu_count() or 1)
+
+# formats of the split parts: extension and encoder arguments,
+# the parts are only decoded again by lalal.ai so a lossless format skips one mp3 generation
+PART_FORMATS = {
+    'mp3': ('mp3', []),
+    'flac': ('flac', ['-c:a', 'flac']),
+    'wav': ('wav', ['-c:a', 'pcm_s16le']),
+}
+
+
+def part_name(file_id, part, extension: str = 'mp3') -> str:
+    return f'{file_id}_{part}.{extension}'
+
+
+def original_part_name(file_id, part) -> str:
+    return part_name(file_id, part, PART_FORMATS[config.PART_FORMAT][0])
+
+
+async def run(cmd, *args) -> bytes:
+    async with semaphore:
+        p = await asyncio.create_subprocess_exec(
+            str(cmd), *map(str, args),
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        out, err = await p.communicate()
+    if p.returncode != 0:
+        raise ffmpeg.Error(Path(cmd).name, out, err)
+    return out
+
+
+async def run_ffmpeg(*ffmpeg_args) -> bytes:
+    return await run(ffmpeg_cmd, *ffmpeg_args)
+
+
+async def probe(path) -> dict:
+    out = await run(ffprobe_cmd, '-show_format', '-show_streams', '-of', 'json', path)
+    return json.loads(out.decode('utf-8'))
+
+
+async def duration(path) -> float:
+    return float((await probe(path))['format']['duration'])
+
+
+def progress_time(out: bytes):
+    # the last progress report holds the final output time
+    progress = [line for line in out.decode('utf-8').splitlines() if line.startswith('out_time_us=')]
+    try:
+        return int(progress[-1].partition('=')[2]) / 1_000_000
+    except (IndexError, ValueError):
+        return None
+
+
+def frames_length(path) -> float:
+    """
+    :return: seconds of audio listed by a framecrc output, up to the end of its last packet
+    """
+    time_base, end = Fraction(0), 0
+    for line in Path(path).read_text().splitlines():
+        if line.startswith('#tb 0:'):
+            time_base = Fraction(line.partition(':')[2].strip())
+        elif line and not line.startswith('#'):
+            _, pts, _, length, *_ = (field.strip() for field in line.split(','))
+            end = max(end, int(pts) + int(length))
+    return float(end * time_base)
+
+
+def measured_outputs(label_hash, label_length, frames: Path) -> list:
+    # fingerprint of the decoded audio for the result cache, written to stdout,
+    # and its length from a listing of packets of about 20 seconds with their timestamps
+    return ['-map', f'[{label_hash}]', '-f', 'hash', '-hash', 'sha256', 'pipe:1',
+            '-map', f'[{label_length}]', '-f', 'framecrc', frames]
+
+
+async def decode_measured(path, graph, outputs):
+    """
+    Decode the possibly corrupted upload once through the graph, its last two branches measured
+
+    :return: seconds of decoded audio and its sha256
+    """
+    frames = Path(path).with_suffix('.frames')
+    try:
+        # one second past the limit is enough to tell the file is too long
+        out = await run_ffmpeg('-err_detect', 'ignore_err', '-fflags', '+discardcorrupt',
+                               '-t', config.MAX_AUDIO_DURATION + 1, '-i', path, '-filter_complex', ';'.join(graph),
+                               '-loglevel', 'error', '-y', *outputs, *measured_outputs('hash', 'length', frames))
+        length = frames_length(frames)
+    finally:
+        frames.unlink(missing_ok=True)
+    return length, out.decode('utf-8').strip().partition('=')[2] or None
+
+
+def measured_branches(label) -> list:
+    return [f'[{label}]asplit=2[hash][length_frames]', '[length_frames]asetnsamples=n=1048576:p=0[length]']
+
+
+async def split(file_id, path, parts_dir):
+    """
+    Split the file into overlapping parts in one decode, the part count follows from the decoded length
+
+    :return: number of parts and sha256 of the decoded audio
+    """
+    logging.debug('Splitting file')
+    # the stream fans out to every part a file within the limit can have, each trimmed with a 1 second overlap
+    # and encoded straight to its upload-ready file, the ones past the end get one padded sample and are dropped
+    branches = part_count(config.MAX_AUDIO_DURATION + 1)
+    labels = ''.join(f'[s{branch}]' for branch in range(branches + 1))
+    graph = [f'[0:a:0]asplit={branches + 1}{labels}', *measured_branches(f's{branches}')]
+    outputs = []
+    for part in range(branches):
+        graph.append(f'[s{part}]atrim=start={part * 59}:duration=60,asetpts=PTS-STARTPTS,apad=whole_len=1[p{part}]')
+        outputs.extend(['-map', f'[p{part}]', *PART_FORMATS[config.PART_FORMAT][1],
+                        parts_dir / original_part_name(file_id, part)])
+    length, content_hash = await decode_measured(path, graph, outputs)
+    parts = usable_parts(length)
+    for part in range(parts or 0, branches):
+        (parts_dir / original_part_name(file_id, part)).unlink(missing_ok=True)
+    if not parts:
+        return None, None
+    logging.debug(f'{parts} parts done, hash {content_hash}')
+    return parts, content_hash
+
+
+def part_count(length: float) -> int:
+    # minute-long parts starting every 59 seconds, a last part shorter than 2 seconds is dropped
+    parts = (length + length // 60) / 60 + 1
+    if parts.is_integer():
+        parts -= 1
+    parts = int(parts)
+    if parts > 1 and length - (parts - 1) * 59 < 2:
+        parts -= 1
+    return parts
+
+
+def usable_parts(length: float):
+    # counted from the decoded stream, parts counted from an underestimated duration would lose the end of the audio
+    logging.debug(f'Duration: {length}')
+    if length > config.MAX_AUDIO_DURATION:
+        return None
+    return part_count(length)
+
+
+async def count_parts(path):
+    """
+    Decode once for the part count and the fingerprint, for cutting the parts one by one afterwards
+
+    :return: number of parts and sha256 of the decoded audio
+    """
+    length, content_hash = await decode_measured(path, ['[0:a:0]anull[s]', *measured_branches('s')], [])
+    return usable_parts(length), content_hash
+
+
+async def split_part(file_id, path, parts_dir, part) -> Path:
+    """
+    Cut one part with input seeking, so every part is ready on its own instead of after the whole split
+
+    :return: path of the part
+    """
+    target = parts_dir / original_part_name(file_id, part)
+    partial = parts_dir / f'partial_{target.name}'  # a part only gets its name once complete
+    await run_ffmpeg('-err_detect', 'ignore_err', '-fflags', '+discardcorrupt', '-ss', part * 59, '-t', 60, '-i', path,
+                     '-map', '0:a:0', *PART_FORMATS[config.PART_FORMAT][1], '-loglevel', 'error', '-y', partial)
+    partial.replace(target)
+    return target
+
+
+def crossfade_chain(first, count, label):
+    filters = []
+    previous = f'[{first}]'
+    for i in range(1, count):
+        output = f'[{label}]' if i == count - 1 else f'[{label}{i}]'
+        filters.append(f'{previous}[{first + i}]acrossfade=d=1:c1=nofade:c2=cub{output}')
+        previous = output
+    return filters
+
+
+async def merge(stem_parts, no_stem_parts, files, title, result_stem, result_no_stem) -> float:
+    """
+    Crossfade the separated parts back together, both results in one ffmpeg process
+
+    :return: duration of the result in seconds
+    """
+    if len(files) == 1:
+        os.rename(stem_parts / files[0], result_stem)
+        os.rename(no_stem_parts / files[0], result_no_stem)
+        return await duration(result_stem)
+    if config.MERGE_ENGINE == 'numpy' and overlap.np is not None:
+        return await merge_pcm(stem_parts, no_stem_parts, files, title, result_stem, result_no_stem)
+    count = len(files)
+    args = [item for folder in (stem_parts, no_stem_parts) for filename in files for item in ('-i', folder / filename)]
+    graph = crossfade_chain(0, count, 'stem') + crossfade_chain(count, count, 'no_stem')
+    args.extend(['-filter_complex', ';'.join(graph)])
+    for label, result in (('stem', result_stem), ('no_stem', result_no_stem)):
+        args.extend([
+            '-map', f'[{label}]',
+            '-c:a', 'libmp3lame',
+            '-q:a', '2',
+            '-metadata', f'title="{title}"',
+            result,
+        ])
+    args = ['-loglevel', 'error', '-nostats', '-progress', 'pipe:1', '-y', *args]
+    logging.debug(f'ffmpeg {args}')
+    out = await run_ffmpeg(*args)
+    length = progress_time(out)
+    return length if length is not None else await duration(result_stem)
+
+
+def read_pcm(path, channels: int):
+    if os.path.getsize(path) == 0:  # np.memmap refuses empty files
+        return overlap.np.zeros((0, channels), dtype=overlap.np.float32)
+    return overlap.np.memmap(path, dtype=overlap.np.float32, mode='r').reshape(-1, channels)
+
+
+def pcm_path(folder, filename, rate, channels) -> Path:
+    return Path(folder) / f'{filename}.{rate}_{channels}.raw'
+
+
+async def premerge(stem_parts, no_stem_parts, filename):
+    """
+    Decode a freshly downloaded part to PCM for the numpy merge, so the merge only has to add and encode
+    """
+    if config.MERGE_ENGINE != 'numpy' or overlap.np is None:
+        return
+    for folder in (stem_parts, no_stem_parts):
+        stream = (await probe(folder / filename))['streams'][0]
+        rate, channels = int(stream['sample_rate']), int(stream['channels'])
+        target = pcm_path(folder, filename, rate, channels)
+        partial = target.with_suffix('.partial')
+        await run_ffmpeg('-loglevel', 'error', '-y', '-i', folder / filename,
+                         '-map', '0:a:0', '-f', 'f32le', '-ar', rate, '-ac', channels, partial)
+        partial.replace(target)
+
+
+async def merge_pcm(stem_parts, no_stem_parts, files, title, result_stem, result_no_stem) -> float:
+    """
+    Same crossfade as merge, done as numpy overlap-add on memory-mapped PCM instead of an acrossfade chain
+
+    :return: duration of the result in seconds
+    """
+    np = overlap.np
+    stream = (await probe(stem_parts / files[0]))['streams'][0]
+    rate, channels = int(stream['sample_rate']), int(stream['channels'])
+    pcm = ['-f', 'f32le', '-ar', rate, '-ac', channels]
+    with tempfile.TemporaryDirectory(dir=Path(result_stem).parent) as tmp:
+        tmp = Path(tmp)
+        # decode every part of both results once, skipping those premerge already decoded
+        raw = [[pcm_path(folder, filename, rate, channels) for filename in files] for folder in (stem_parts, no_stem_parts)]
+        missing = [(folder / filename, raw[n][i]) for n, folder in enumerate((stem_parts, no_stem_parts))
+                   for i, filename in enumerate(files) if not raw[n][i].exists()]
+        if missing:
+            args = [item for source, _ in missing for item in ('-i', source)]
+            for i, _ in enumerate(missing):
+                args.extend(['-map', f'{i}:a:0', *pcm, tmp / f'{i}.raw'])
+            await run_ffmpeg('-loglevel', 'error', '-y', *args)
+            for i, (_, target) in enumerate(missing):
+                (tmp / f'{i}.raw').replace(target)
+
+        samples = 0
+        args = []
+        for n, (label, result) in enumerate((('stem', result_stem), ('no_stem', result_no_stem))):
+            parts = [read_pcm(path, channels) for path in raw[n]]
+            out = np.memmap(tmp / f'{label}.raw', dtype=np.float32, mode='w+',
+                            shape=(max(overlap.merged_length([len(part) for part in parts], rate), 1), channels))
+            async with semaphore:
+                samples = await asyncio.to_thread(overlap.overlap_add, parts, rate, out)
+            out.flush()
+            del out, parts
+            args.extend([*pcm, '-i', tmp / f'{label}.raw'])
+        # one encode for both results
+        for n, result in enumerate((result_stem, result_no_stem)):
+            args.extend([
+                '-map', f'{n}:a:0',
+                '-c:a', 'libmp3lame',
+                '-q:a', '2',
+                '-metadata', f'title="{title}"',
+                result,
+            ])
+        await run_ffmpeg('-loglevel', 'error', '-y', *args)
+    for path in raw[0] + raw[1]:  # the decoded parts are several times the size of the job
+        path.unlink(missing_ok=True)
+    return samples / rate
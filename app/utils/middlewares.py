@@ -1,6 +1,8 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 from aiogram.types import TelegramObject, User
 from aiogram.utils.i18n import SimpleI18nMiddleware, I18n
+from app import config
+from app.utils.cache import LRUCache
 from app.utils.database_connection import DatabaseConnection
 
 
@@ -12,26 +14,49 @@ class DBI18nMiddleware(SimpleI18nMiddleware):
         middleware_key: str = "i18n_middleware",
     ) -> None:
         super().__init__(i18n=i18n, i18n_key=i18n_key, middleware_key=middleware_key)
+        # user_id -> (users.id, locale), set_locale is the only writer besides the first contact
+        self.users = LRUCache(config.LOCALE_CACHE_SIZE, config.LOCALE_CACHE_TTL)
 
     async def get_locale(self, event: TelegramObject, data: Dict[str, Any]) -> str:
         event_from_user: Optional[User] = data.get("event_from_user", None)
         if event_from_user is None:
             return self.i18n.default_locale
-        with DatabaseConnection() as db:
+        user = self.users.get(event_from_user.id)
+        if user is None:
+            user = await self.load_user(event_from_user.id)
+        if user is None:
+            locale = await super().get_locale(event=event, data=data)
+            user = await self.register_user(event_from_user.id, locale)
+        return user[1]
+
+    async def load_user(self, user_id: int) -> Optional[Tuple[int, str]]:
+        async with DatabaseConnection() as db:
+            conn, cursor = db
+            await cursor.execute('SELECT id, locale FROM users WHERE user_id=%s', [user_id])
+            user = await cursor.fetchone()
+        if user is not None:
+            self.users.set(user_id, tuple(user))
+        return user
+
+    async def register_user(self, user_id: int, locale: str) -> Tuple[int, str]:
+        async with DatabaseConnection() as db:
             conn, cursor = db
-            cursor.execute('SELECT locale FROM users WHERE user_id=%s', [event_from_user.id])
-            locale = cursor.fetchone()
-            if not locale:
-                locale = await super().get_locale(event=event, data=data)
-                cursor.execute('INSERT INTO users (user_id, locale) VALUES (%s, %s)', [event_from_user.id, locale])
-                conn.commit()
-            else:
-                locale = locale[0]
-        return locale
+            # concurrent first messages resolve to the same row through the unique key on user_id
+            await cursor.execute('INSERT INTO users (user_id, locale) VALUES (%s, %s) '
+                                 'ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)', [user_id, locale])
+            user = (cursor.lastrowid, locale)
+        self.users.set(user_id, user)
+        return user
+
+    async def get_user_id(self, user_id: int) -> Optional[int]:
+        user = self.users.get(user_id) or await self.load_user(user_id)
+        return user[0] if user else None
 
     async def set_locale(self, user_id: int, locale: str):
         self.i18n.current_locale = locale
-        with DatabaseConnection() as db:
+        async with DatabaseConnection() as db:
             conn, cursor = db
-            cursor.execute('UPDATE users SET locale=%s WHERE user_id=%s', [locale, user_id])
-            conn.commit()
+            await cursor.execute('UPDATE users SET locale=%s WHERE user_id=%s', [locale, user_id])
+        user = self.users.get(user_id)
+        if user is not None:
+            self.users.set(user_id, (user[0], locale))
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+from contextlib import suppress
+from pathlib import Path
+from app import config
+from app.misc import files_dir
+from app.utils.file import ensure_dir
+
+
+# the bot pokes the updater through a local unix socket right after a job is queued,
+# the updater keeps a slow database poll for anything missed while it was down
+socket_path = Path(config.UPDATER_SOCKET or files_dir / 'updater.sock')
+
+
+async def notify_updater(file_id: int):
+    if not hasattr(asyncio, 'open_unix_connection'):
+        return
+    with suppress(OSError, asyncio.TimeoutError):
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(socket_path), 1)
+        writer.write(f'{file_id}\n'.encode())
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+
+async def serve_notifications(callback) -> asyncio.AbstractServer | None:
+    if not hasattr(asyncio, 'start_unix_server'):
+        logging.warning('Unix sockets are not supported, falling back to polling')
+        return None
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        with suppress(OSError, ValueError):
+            while line := await reader.readline():
+                callback(int(line))
+        writer.close()
+
+    ensure_dir(socket_path.parent)
+    socket_path.unlink(missing_ok=True)
+    return await asyncio.start_unix_server(handle, socket_path)
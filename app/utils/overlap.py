@@ -0,0 +1,43 @@
+try:
+    import numpy as np
+except ImportError:  # optional, only needed for MERGE_ENGINE=numpy
+    np = None
+
+
+def fade_in(samples: int):
+    # same curve as ffmpeg's acrossfade c2=cub, the outgoing part is not faded (c1=nofade)
+    return ((np.arange(samples, dtype=np.float64) / samples) ** 3).astype(np.float32)[:, None]
+
+
+def overlaps(lengths, overlap: int):
+    """
+    Overlap of every part with the audio before it
+
+    :return: list of overlaps in samples, the first part has none
+    """
+    result = [0]
+    total = lengths[0]
+    for length in lengths[1:]:
+        result.append(min(overlap, length, total))
+        total += length - result[-1]
+    return result
+
+
+def overlap_add(parts, overlap: int, out):
+    """
+    Crossfade parts into a preallocated buffer of shape (samples, channels)
+
+    :return: number of samples written
+    """
+    position = 0
+    for part, samples in zip(parts, overlaps([len(part) for part in parts], overlap)):
+        start = position - samples
+        if samples:
+            out[start:position] += part[:samples] * fade_in(samples)
+        out[position:start + len(part)] = part[samples:]
+        position = start + len(part)
+    return position
+
+
+def merged_length(lengths, overlap: int) -> int:
+    return sum(lengths) - sum(overlaps(lengths, overlap))
@@ -0,0 +1,33 @@
+import random
+
+
+class Backoff:
+    def __init__(self, initial: float, maximum: float, factor: float = 2, jitter: float = 0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class DurationEstimate:
+    """
+    Exponential moving average of observed durations, used to sleep until a result is likely ready
+    """
+
+    def __init__(self, initial: float, alpha: float = 0.3):
+        self.value = initial
+        self.alpha = alpha
+        self.samples = 0
+
+    def update(self, duration: float):
+        self.value += self.alpha * (duration - self.value) if self.samples else duration - self.value
+        self.samples += 1
@@ -0,0 +1,111 @@
+import os
+import shutil
+import logging
+from pathlib import Path
+from app import config
+from app.misc import files_dir
+from app.utils.file import ensure_dir
+from app.utils.database_connection import DatabaseConnection
+
+
+# merged results keyed by telegram's file_unique_id or the hash of the decoded audio, plus stem and level
+cache_dir = files_dir / 'cache'
+
+
+class Result:
+    """
+    Merged stem and no-stem tracks, as local files and as telegram file ids once they were uploaded
+    """
+
+    def __init__(self, stem: Path, no_stem: Path, duration: int,
+                 stem_file_id: str = None, no_stem_file_id: str = None, cache_id: int = None):
+        self.stem = stem
+        self.no_stem = no_stem
+        self.duration = duration
+        self.stem_file_id = stem_file_id
+        self.no_stem_file_id = no_stem_file_id
+        self.cache_id = cache_id
+
+    @property
+    def uploaded(self) -> bool:
+        return self.stem_file_id is not None and self.no_stem_file_id is not None
+
+
+def entry_dir(cache_id: int) -> Path:
+    return cache_dir / str(cache_id)
+
+
+def _link(src: Path, dst: Path):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+async def lookup(stem, level, file_unique_id=None, content_hash=None):
+    if file_unique_id is None and content_hash is None:
+        return None
+    column, value = ('file_unique_id', file_unique_id) if file_unique_id is not None else ('content_hash', content_hash)
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute(f'SELECT id, duration, stem_file_id, no_stem_file_id FROM result_cache '
+                             f'WHERE {column}=%s AND stem=%s AND level=%s ORDER BY id DESC LIMIT 1',
+                             [value, stem, level])
+        entry = await cursor.fetchone()
+        if entry is None:
+            return None
+        cache_id, duration, stem_file_id, no_stem_file_id = entry
+        directory = entry_dir(cache_id)
+        result = Result(directory / 'stem.mp3', directory / 'no_stem.mp3', duration,
+                        stem_file_id, no_stem_file_id, cache_id)
+        # uploaded results are sent by file id and need no local files
+        if not result.uploaded and (not result.stem.exists() or not result.no_stem.exists()):
+            return None  # still being stored, or lost, it ages out through eviction
+        await cursor.execute('UPDATE result_cache SET used_at=NOW() WHERE id=%s', [cache_id])
+    logging.debug(f'Result cache hit {cache_id} for {column}={value}')
+    return result
+
+
+async def store(stem, level, file_unique_id, content_hash, result: Result):
+    size = result.stem.stat().st_size + result.no_stem.stat().st_size
+    if size > config.RESULT_CACHE_MAX_BYTES:
+        return
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('INSERT INTO result_cache (file_unique_id, content_hash, stem, level, duration, size) '
+                             'VALUES (%s, %s, %s, %s, %s, %s)',
+                             [file_unique_id, content_hash, stem, level, result.duration, size])
+        result.cache_id = cursor.lastrowid
+    directory = ensure_dir(entry_dir(result.cache_id))
+    _link(result.stem, directory / 'stem.mp3')
+    _link(result.no_stem, directory / 'no_stem.mp3')
+    await evict()
+
+
+async def set_file_ids(result: Result):
+    if result.cache_id is None or not result.uploaded:
+        return
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('UPDATE result_cache SET stem_file_id=%s, no_stem_file_id=%s WHERE id=%s',
+                             [result.stem_file_id, result.no_stem_file_id, result.cache_id])
+
+
+async def evict():
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache')
+        excess = int((await cursor.fetchone())[0]) - config.RESULT_CACHE_MAX_BYTES
+        if excess <= 0:
+            return
+        await cursor.execute('SELECT id, size FROM result_cache ORDER BY used_at, id')
+        evicted = []
+        for cache_id, size in await cursor.fetchall():
+            if excess <= 0:
+                break
+            evicted.append(cache_id)
+            excess -= size
+        await cursor.execute(f'DELETE FROM result_cache WHERE id IN ({", ".join(["%s"] * len(evicted))})', evicted)
+    for cache_id in evicted:
+        shutil.rmtree(entry_dir(cache_id), ignore_errors=True)
+    logging.debug(f'Result cache evicted {len(evicted)} entries')
@@ -0,0 +1,25 @@
+import json
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable, Dict
+
+
+# live counters of long-running components, dumped periodically by the daemons
+providers: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, provider: Callable[[], dict]):
+    providers[name] = provider
+
+
+def collect() -> dict:
+    return {name: provider() for name, provider in providers.items()}
+
+
+async def dump_periodically(path: Path, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        data = collect()
+        logging.debug(f'Stats: {data}')
+        path.write_text(json.dumps(data, indent=2, default=str))
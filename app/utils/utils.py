@@ -1,23 +1,25 @@
 import os
 import json
 import ffmpeg
+import hashlib
 import logging
 import traceback
+import asyncio
 import aiohttp
-import subprocess
 from contextlib import suppress
-from time import time
-from aiogram import types
+from time import time, monotonic
+from aiogram import types, enums
 from aiogram.types import InlineKeyboardButton, ReplyKeyboardRemove
 from aiogram.filters import callback_data
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram.exceptions import TelegramAPIError
 from aiogram.utils.i18n import gettext as _
 from app import bot, config
-from app.utils import helper
-from app.misc import files_dir, ffmpeg_cmd, ffprobe_cmd
+from app.utils import helper, result_cache
+from app.utils.result_cache import Result
 from app.utils.database_connection import DatabaseConnection
-from app.utils.file import ensure_dir
+from app.utils.workspace import workspace, JOB_SIZE_FACTOR
+from app.utils.notify import notify_updater
 from lalalai.audio import Audio
 
 
@@ -121,110 +123,125 @@ async def exec_protected(func, *args, **kwargs):
                 await bot.send_message(config.BOT_ADMIN, stderr[-4096:])
 
 
-def set_audiofile_status(file_id, status):
-    with DatabaseConnection() as db:
+async def set_audiofile_status(file_id, status):
+    async with DatabaseConnection() as db:
         conn, cursor = db
-        cursor.execute('UPDATE audiofiles SET status=%s WHERE id=%s', [status, file_id])
-        conn.commit()
+        await cursor.execute('UPDATE audiofiles SET status=%s WHERE id=%s', [status, file_id])
 
 
-async def download_file(user_id: int, file: types.Audio, data):
+async def save_delivery(file_id, result: Result):
+    # file ids of the sent tracks, for resending without uploading again
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('UPDATE audiofiles SET duration=%s, stem_file_id=%s, no_stem_file_id=%s WHERE id=%s',
+                             [result.duration, result.stem_file_id, result.no_stem_file_id, file_id])
+
+
+# uploads and sends by file id, in the updater stats
+delivery_stats = {'tracks': 0, 'by_file_id': 0, 'uploads': 0, 'upload_bytes': 0, 'upload_seconds': 0.0}
+
+
+async def send_track(chat_id: int, title: str, path, file_id, duration: int, caption: str):
+    """
+    :return: telegram file id of the sent track and the bytes uploaded for it
+    """
+    size = 0
+    if file_id is None:
+        size = os.path.getsize(path)
+        audio = types.FSInputFile(path, filename=title)
+    else:
+        audio = file_id
+    start = monotonic()
+    message = await bot.send_audio(chat_id, audio, duration=duration, title=title, caption=caption)
+    delivery_stats['tracks'] += 1
+    if file_id is None:
+        delivery_stats['uploads'] += 1
+        delivery_stats['upload_bytes'] += size
+        delivery_stats['upload_seconds'] += monotonic() - start
+    else:
+        delivery_stats['by_file_id'] += 1
+    return message.audio.file_id, size
+
+
+async def send_result(chat_id: int, title: str, result: Result) -> bool:
+    """
+    Send both tracks concurrently, by file id when they were uploaded before, and keep the new file ids
+
+    :return: whether both tracks were sent
+    """
+    start = monotonic()
+    try:
+        await bot.send_chat_action(chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
+        (stem_file_id, stem_size), (no_stem_file_id, no_stem_size) = await asyncio.gather(
+            send_track(chat_id, title, result.stem, result.stem_file_id, result.duration, 'With stem'),
+            send_track(chat_id, title, result.no_stem, result.no_stem_file_id, result.duration, 'No stem'),
+        )
+    except TelegramAPIError as e:
+        logging.error(f'Error sending audio: {e}')
+        return False
+    except Exception as e:
+        logging.error(f'Error: {e}')
+        return False
+    result.stem_file_id, result.no_stem_file_id = stem_file_id, no_stem_file_id
+    logging.debug(f'Result {title} sent to {chat_id} in {monotonic() - start:.1f}s, '
+                  f'{stem_size + no_stem_size} bytes uploaded')
+    return True
+
+
+async def download_file(chat_id: int, user_id: int, file: types.Audio, data):
     filename = (file.title or file.file_name or str(int(time())))[:255]
+    stem, level = data['stem'], data['level']
 
-    with DatabaseConnection() as db:
+    hit = await result_cache.lookup(stem, level, file_unique_id=file.file_unique_id)
+    async with DatabaseConnection() as db:
         conn, cursor = db
-        cursor.execute('SELECT id FROM users WHERE user_id=%s', [user_id])
-        user_id = cursor.fetchone()[0]
-        cursor.execute('INSERT INTO audiofiles (user_id, title, stem, level) '
-                       'VALUES (%s, %s, %s, %s)',
-                       [user_id, filename, data['stem'], data['level']])
-        conn.commit()
-        file_id = cursor.lastrowid
-
-    destination_file = ensure_dir(files_dir / 'original') / f'{file_id}.mp3'
+        parent_id, lock = None, None
+        try:
+            if hit is None:
+                # a named lock per submission key makes the lookup and the insert one step across processes,
+                # so of two identical simultaneous submissions the second always finds the first as its parent
+                key = 'coalesce:' + hashlib.sha1(f'{file.file_unique_id}:{stem}:{level}'.encode()).hexdigest()
+                await cursor.execute('SELECT GET_LOCK(%s, %s)', [key, config.MYSQL_QUERY_TIMEOUT // 2])
+                if (await cursor.fetchone())[0] != 1:  # timed out or failed, without it the race is back
+                    logging.error(f'Error locking submission {key}')
+                    raise TelegramAPIError
+                lock = key
+                # identical submission already in flight, its result is delivered to this job as well
+                await cursor.execute('SELECT id FROM audiofiles '
+                                     'WHERE file_unique_id=%s AND stem=%s AND level=%s AND parent_id IS NULL '
+                                     'AND status IN (\'init\', \'await\', \'processing\') '
+                                     'ORDER BY id LIMIT 1',
+                                     [file.file_unique_id, stem, level])
+                parent = await cursor.fetchone()
+                parent_id = parent[0] if parent else None
+            await cursor.execute('INSERT INTO audiofiles (user_id, title, file_unique_id, stem, level, parent_id) '
+                                 'VALUES (%s, %s, %s, %s, %s, %s)',
+                                 [user_id, filename, file.file_unique_id, stem, level, parent_id])
+            file_id = cursor.lastrowid
+        finally:
+            if lock is not None:
+                # a broken connection drops the lock with its session, the original error is the one to raise
+                with suppress(Exception):
+                    await cursor.execute('SELECT RELEASE_LOCK(%s)', [lock])
+
+    if hit is not None:
+        uploaded = hit.uploaded
+        if await send_result(chat_id, filename, hit):
+            await save_delivery(file_id, hit)
+            if not uploaded:
+                await result_cache.set_file_ids(hit)
+        await set_audiofile_status(file_id, 'complete')
+        return
+
+    workspace.create(file_id, (file.file_size or 0) * JOB_SIZE_FACTOR)
+    destination_file = workspace.path(file_id, 'original.mp3')
     try:
         await bot.download(file, destination_file)
     except aiohttp.client_exceptions.ClientPayloadError as e:
         logging.error(f'Error downloading file: {e}')
-        set_audiofile_status(file_id, 'error')
+        await set_audiofile_status(file_id, 'error')
         raise TelegramAPIError
-    set_audiofile_status(file_id, 'await')
-
-
-def split_file(file_id, path):
-    duration = float(ffmpeg.probe(path, ffprobe_cmd)['format']['duration'])
-    logging.debug(f'Duration: {duration}')
-    if duration > config.MAX_AUDIO_DURATION:
-        set_audiofile_status(file_id, 'error')
-        return None
-
-    parts = (duration + duration // 60) / 60 + 1
-    if parts.is_integer():
-        parts -= 1
-    parts = int(parts)
-    logging.debug('Splitting file')
-
-    parts_dir = ensure_dir(files_dir / 'original_parts')
-
-    stream = ffmpeg.input(path)
-    for part in range(parts):
-        stream.audio \
-            .filter('atrim', start=part * 60 - part, duration=60) \
-            .output(str(parts_dir / f'{file_id}_{part}.mp3')) \
-            .global_args('-loglevel', 'error') \
-            .run(str(ffmpeg_cmd), overwrite_output=True)
-        logging.debug(f'Part {part} done')
-    try:
-        last_part_duration = float(ffmpeg.probe(parts_dir / f'{file_id}_{parts - 1}.mp3', ffprobe_cmd)['format']['duration'])
-    except ffmpeg.Error:
-        return None
-    if last_part_duration < 2:
-        parts -= 1
-    return parts
-
-
-def recompile_file(file_id):  # recompile file to ensure it's not corrupted
-    inp = files_dir / 'original' / f'{file_id}.mp3'
-    out = files_dir / 'original' / f'{file_id}_copy.mp3'
-    args = [
-        '-i', inp,
-        '-vn',
-        '-c:a', 'libmp3lame',
-        '-q:a', '2',
-        '-loglevel', 'error',
-        out,
-    ]
-    ffmpeg_command_line(*args)
-    inp.unlink()
-    out.rename(inp)
-
-
-def ffmpeg_command_line(*ffmpeg_args):
-    p = subprocess.Popen([ffmpeg_cmd, *ffmpeg_args], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if p.returncode != 0:
-        raise ffmpeg.Error('ffmpeg', out, err)
-
-
-def crossfade_merge(result_parts, files, title, result):
-    if len(files) == 1:
-        os.rename(result_parts / files[0], result)
-        return
-    args = [item for filename in files for item in ('-i', result_parts / filename)]
-    args.append('-filter_complex')
-    acrossfade_filter = ''
-    count = len(files)
-    for i in range(count - 1):
-        prefix = f'[{"a" if i else ""}{i}][{i + 1}]'
-        suffix = f'[a{i + 1}];' if i < count - 2 else ''
-        acrossfade_filter += f'{prefix}acrossfade=d=1:c1=nofade:c2=cub{suffix}'
-    args.append(acrossfade_filter)
-    args.extend([
-        '-c:a', 'libmp3lame',
-        '-q:a', '2',
-        '-metadata', f'title="{title}"',
-        '-loglevel', 'error',
-        result,
-    ])
-    logging.debug(f'ffmpeg {args}')
-    ffmpeg_command_line(*args)
+    # coalesced jobs still keep their own copy, the updater processes them alone if the parent fails
+    await set_audiofile_status(file_id, 'await')
+    if parent_id is None:
+        await notify_updater(file_id)
@@ -0,0 +1,177 @@
+import os
+import shutil
+import logging
+from pathlib import Path
+from app import config
+from app.misc import files_dir
+from app.utils.file import ensure_dir
+
+
+# a job grows to about this many times its upload: the original, its parts, two sets of result parts and two results
+JOB_SIZE_FACTOR = 6
+
+
+# flat per-stage folders of the layout before per-job directories
+LEGACY_DIRS = ('original', 'original_parts', 'result_parts', 'result', 'pcm')
+
+
+def tree_stat(path):
+    """
+    :return: total bytes and the newest modification time of the files under path
+    """
+    size, mtime = 0, 0.0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_size, sub_mtime = tree_stat(entry.path)
+                    size, mtime = size + sub_size, max(mtime, sub_mtime)
+                else:
+                    stat = entry.stat(follow_symlinks=False)
+                    size, mtime = size + stat.st_size, max(mtime, stat.st_mtime)
+    except FileNotFoundError:
+        pass
+    return size, mtime
+
+
+def tree_size(path) -> int:
+    return tree_stat(path)[0]
+
+
+class Workspace:
+    """
+    One directory per job, on a RAM-backed filesystem (tmpfs, /dev/shm) while it fits the byte budget, on disk otherwise
+
+    Placement is read back from the directories themselves, so the bot and the updater agree without sharing state.
+    """
+
+    def __init__(self, disk_root: Path, memory_root: Path = None, budget: int = 0):
+        self.disk = disk_root / 'jobs'
+        self.memory = memory_root / 'jobs' if memory_root is not None and budget > 0 else None
+        self.budget = budget
+        self.spills = 0
+
+    @property
+    def roots(self):
+        return [root for root in (self.memory, self.disk) if root is not None]
+
+    def memory_used(self) -> int:
+        return tree_size(self.memory) if self.memory is not None else 0
+
+    def find(self, file_id):
+        for root in self.roots:
+            if (root / str(file_id)).is_dir():
+                return root / str(file_id)
+        return None
+
+    def create(self, file_id, expected: int = 0) -> Path:
+        """
+        Directory of a new job, in memory if the expected size still fits the budget
+
+        :return: path of the job directory
+        """
+        directory = self.find(file_id)
+        if directory is None:
+            fits = self.memory is not None and self.memory_used() + expected <= self.budget
+            directory = ensure_dir((self.memory if fits else self.disk) / str(file_id))
+        return directory
+
+    def job(self, file_id) -> Path:
+        return self.find(file_id) or ensure_dir(self.disk / str(file_id))
+
+    def dir(self, file_id, *names) -> Path:
+        return ensure_dir(self.job(file_id).joinpath(*names))
+
+    def path(self, file_id, *names) -> Path:
+        path = self.job(file_id).joinpath(*names)
+        ensure_dir(path.parent)
+        return path
+
+    def spill(self, file_id) -> Path:
+        """
+        Move the job to disk while the memory is over budget, only call it between stages of the job
+
+        :return: path of the job directory
+        """
+        directory = self.job(file_id)
+        if directory.parent != self.memory or self.memory_used() <= self.budget:
+            return directory
+        target = self.disk / str(file_id)
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.move(directory, ensure_dir(self.disk) / str(file_id))
+        self.spills += 1
+        logging.info(f'Workspace of job {file_id} spilled to disk')
+        return target
+
+    def usage(self, file_id) -> int:
+        directory = self.find(file_id)
+        return tree_size(directory) if directory is not None else 0
+
+    def remove(self, file_id):
+        for root in self.roots:
+            shutil.rmtree(root / str(file_id), ignore_errors=True)
+
+    def jobs(self):
+        """
+        Every job directory, one entry per job and no per-file listing of shared folders
+
+        :return: list of (name, path, place, bytes, newest modification time)
+        """
+        jobs = []
+        for root, place in ((self.memory, 'memory'), (self.disk, 'disk')):
+            if root is None or not root.is_dir():
+                continue
+            for directory in root.iterdir():
+                jobs.append((directory.name, directory, place, *tree_stat(directory)))
+        return jobs
+
+    @staticmethod
+    def legacy_files(root: Path):
+        """
+        Files of the flat layout: original/<id>.mp3, original_parts/<id>_<part>.<ext>,
+        result_parts/<stem>/<id>_<part>.mp3 and result/<stem>/<id>.mp3
+
+        :return: list of (job id, path, names of the file inside the job directory)
+        """
+        files = []
+        for name in ('original', 'original_parts', 'result_parts', 'result'):
+            if not (root / name).is_dir():
+                continue
+            for path in (root / name).rglob('*'):
+                file_id = path.name.partition('_')[0].partition('.')[0]
+                if not path.is_file() or not file_id.isdigit():
+                    continue
+                if name == 'original':
+                    names = ('original.mp3',)
+                elif name == 'result':
+                    names = ('result', f'{path.parent.name}.mp3')
+                else:
+                    names = path.relative_to(root).parts
+                files.append((int(file_id), path, names))
+        return files
+
+    def remove_legacy(self, root: Path, active):
+        """
+        Move the files of active jobs into their job directories and remove the flat folders with the rest
+        """
+        for file_id, path, names in self.legacy_files(root):
+            if file_id in active:
+                shutil.move(path, self.path(file_id, *names))
+        for name in LEGACY_DIRS:
+            if (root / name).is_dir():
+                logging.info(f'Removing legacy folder {root / name}')
+                shutil.rmtree(root / name, ignore_errors=True)
+
+    def stats(self) -> dict:
+        jobs = self.jobs()
+        return {
+            'memory_used': sum(size for _, _, place, size, _ in jobs if place == 'memory'),
+            'disk_used': sum(size for _, _, place, size, _ in jobs if place == 'disk'),
+            'budget': self.budget,
+            'spills': self.spills,
+            'jobs': {name: {'place': place, 'bytes': size} for name, _, place, size, _ in jobs},
+        }
+
+
+workspace = Workspace(files_dir, Path(config.WORKSPACE_MEMORY_DIR) if config.WORKSPACE_MEMORY_DIR else None,
+                      config.WORKSPACE_MEMORY_BUDGET)
@@ -1,5 +1,19 @@
-import aiohttp
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
 from app import config
+from app.utils.circuit import CircuitBreaker
+from app.utils import http
+from app.utils.governor import Governor
+from app.utils.polling import Backoff, DurationEstimate
+
+
+# shared by every captcha task of the process
+breaker = CircuitBreaker('capsolver', config.BREAKER_FAILURES, config.BREAKER_ERROR_RATE,
+                         config.BREAKER_WINDOW, config.BREAKER_RESET_TIMEOUT)
+governor = Governor('capsolver', config.CAPSOLVER_RATE, config.CAPSOLVER_BURST, 1, config.CAPSOLVER_MAX_CONCURRENCY,
+                    breaker=breaker)
 
 
 class Api:
@@ -13,13 +27,21 @@ class Api:
         self.success = True
         self.error = None
         self.result = None
-        self.session = session or aiohttp.ClientSession()
+        self.session = session or http.get_session()
 
     def handle_response(self, res):
         if res['errorId'] != 0:
             self.success = False
             self.error = res['errorCode']
 
+    async def _post(self, path, data):
+        async with governor.slot(path) as call:
+            res = await self.session.post(self.api_url + path, json=data, timeout=http.API_TIMEOUT)
+            call.ok = res.status < 500 and res.status != 429
+            res = await res.json()
+            call.ok = call.ok and res.get('errorId') == 0
+        return res
+
     async def create_task(self):
         data = {
             'clientKey': self.api_key,
@@ -29,8 +51,7 @@ class Api:
                 'websiteKey': self.website_key
             }
         }
-        res = await self.session.post(self.api_url + '/createTask', json=data, timeout=10)
-        res = await res.json()
+        res = await self._post('/createTask', data)
         self.handle_response(res)
         if self.success:
             self.task_id = res['taskId']
@@ -40,10 +61,199 @@ class Api:
             'clientKey': self.api_key,
             'taskId': self.task_id
         }
-        res = await self.session.post(self.api_url + '/getTaskResult', json=data, timeout=10)
-        res = await res.json()
+        res = await self._post('/getTaskResult', data)
         self.handle_response(res)
         if not self.success:
             return
         if res['status'] == 'ready':
             self.result = res['solution']['token']
+
+
+# time from task creation to a solved token, learned from solved tasks
+solve_time = DurationEstimate(config.CAPTCHA_EXPECTED_TIME)
+
+
+async def solve(session) -> str:
+    api = Api(session)
+    start = monotonic()
+    await api.create_task()
+    backoff = Backoff(config.POLL_MIN_INTERVAL, config.POLL_MAX_INTERVAL)
+    if api.success:
+        await asyncio.sleep(max(solve_time.value, config.POLL_MIN_INTERVAL))
+    while api.success and not api.result:
+        await api.check_task()
+        logging.debug(f'Checking captcha task {api.task_id}')
+        if not api.result:
+            await asyncio.sleep(backoff.next())
+    if api.success:
+        solve_time.update(monotonic() - start)
+    if not api.success:
+        logging.error(f'Error solving captcha: {api.error}')
+        raise TimeoutError
+    logging.debug(f'Captcha solved: {api.result[:10]}...')
+    return api.result
+
+
+class Reservation:
+    def __init__(self, pool: 'TokenPool', count: int):
+        self.pool = pool
+        self.count = count
+        pool.demand += count
+        pool.wakeup.set()
+
+    async def get(self) -> str:
+        if self.count > 0:
+            self.count -= 1
+            self.pool.demand -= 1
+        return await self.pool.get()
+
+    def put_back(self, token: str):
+        self.pool.put_back(token)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.demand -= self.count
+        self.count = 0
+
+
+class TokenPool:
+    """
+    Keeps solved Turnstile tokens ready ahead of demand
+
+    Idle it holds `size` tokens, reservations and queued jobs raise the target up to `max_size`.
+    Tokens older than `ttl` are dropped as expired, issued tokens that went unused can be put back.
+    """
+
+    def __init__(self, size: int, max_size: int, ttl: float, session=None):
+        self.size = size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.session = session
+        self.tokens = deque()
+        self.issued_tokens = {}  # token -> expiry, for tokens put back unused
+        self.waiters = deque()
+        self.wakeup = asyncio.Event()
+        self.demand = 0
+        self.backlog = 0
+        self.solving = 0
+        self.solved = 0
+        self.issued = 0
+        self.failed = 0
+        self.expired = 0
+        self.returned = 0
+        self.solve_time = 0.0
+        self.tasks = set()
+
+    def reserve(self, count: int) -> Reservation:
+        return Reservation(self, count)
+
+    def set_backlog(self, jobs: int):
+        self.backlog = jobs
+        self.wakeup.set()
+
+    def target(self) -> int:
+        return min(self.max_size, max(self.size, self.demand + self.backlog + len(self.waiters)))
+
+    def drop_expired(self):
+        now = monotonic()
+        while self.tokens and self.tokens[0][1] <= now:
+            self.tokens.popleft()
+            self.expired += 1
+        for token, expiry in list(self.issued_tokens.items()):
+            if expiry <= now:
+                del self.issued_tokens[token]
+
+    def issue(self, token: str, expiry: float) -> str:
+        self.issued += 1
+        self.issued_tokens[token] = expiry
+        return token
+
+    def put_back(self, token: str):
+        # a token issued to an upload that failed is still unused, it goes to the next part instead of being lost
+        expiry = self.issued_tokens.pop(token, None)
+        if expiry is None or expiry <= monotonic():
+            self.expired += 1
+            return
+        self.returned += 1
+        self.issued -= 1
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(self.issue(token, expiry))
+                return
+        self.tokens = deque(sorted([*self.tokens, (token, expiry)], key=lambda item: item[1]))
+        self.wakeup.set()
+
+    async def get(self) -> str:
+        self.drop_expired()
+        if self.tokens:
+            return self.issue(*self.tokens.popleft())
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.wakeup.set()
+        try:
+            return await waiter
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    async def _solve(self):
+        start = monotonic()
+        try:
+            token = await solve(self.session)
+        except Exception as e:
+            self.failed += 1
+            if not isinstance(e, TimeoutError):
+                logging.error(f'Error solving captcha: {e}')
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_exception(TimeoutError())
+                    break
+            await asyncio.sleep(3)
+            return
+        finally:
+            self.solving -= 1
+            self.wakeup.set()
+        self.solved += 1
+        self.solve_time += monotonic() - start
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(self.issue(token, start + self.ttl))
+                return
+        self.tokens.append((token, start + self.ttl))
+
+    async def run(self):
+        if self.session is None:
+            self.session = http.get_session()
+        while True:
+            self.drop_expired()
+            while len(self.tokens) + self.solving < self.target():
+                self.solving += 1
+                task = asyncio.create_task(self._solve())
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            self.wakeup.clear()
+            timeout = self.tokens[0][1] - monotonic() if self.tokens else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'ready': len(self.tokens),
+            'solving': self.solving,
+            'waiting': len(self.waiters),
+            'target': self.target(),
+            'solved': self.solved,
+            'issued': self.issued,
+            'failed': self.failed,
+            'expired': self.expired,
+            'returned': self.returned,
+            'solve_latency': self.solve_time / self.solved if self.solved else None,
+            'waste_rate': self.expired / self.solved if self.solved else None,
+        }
@@ -1,165 +1,551 @@
+import os
 import ffmpeg
+import shutil
+import signal
+import socket
 import logging
 import asyncio
-from aiohttp import ClientSession, ClientTimeout
-from aiogram import types, enums
-from aiogram import exceptions
-from app.utils import utils
-from app.utils.file import ensure_dir
-from app.utils.database_connection import DatabaseConnection
-from app.misc import files_dir, ffprobe_cmd, base_headers
-from app import bot
-from lalalai import Api as LalalaiApi
-from capsolver import Api as CapsolverApi
-
-
-async def get_captcha_token(session) -> str | None:
-    api = CapsolverApi(session)
-    await api.create_task()
-    while api.success and not api.result:
-        await api.check_task()
-        logging.debug(f'Checking captcha task {api.task_id}')
-        await asyncio.sleep(3)
-    if not api.success:
-        logging.error(f'Error solving captcha: {api.error}')
-        raise TimeoutError
-    logging.debug(f'Captcha solved: {api.result[:10]}...')
-    return api.result
+import itertools
+from time import time
+from contextlib import suppress
+from aiohttp import ClientError
+from app.utils import utils, media, result_cache, stats, checkpoints, http
+from app.utils.checkpoints import reached
+from app.utils.polling import Backoff
+from app.utils.workspace import workspace
+from app.utils.result_cache import Result
+from app.utils.notify import serve_notifications
+from app.utils.database_connection import DatabaseConnection, close_pool
+from app.misc import files_dir
+from app import config
+import lalalai
+import capsolver
+from lalalai import Api as LalalaiApi, Checker as LalalaiChecker
+from capsolver import TokenPool
 
 
-async def process_files(filename, file_id, stem, level, session):
-    try:
-        api = LalalaiApi(filename, stem, level, session)
-        await api.upload_file()
-        logging.debug(f'File {filename} uploaded')
-        api.captcha = await get_captcha_token(session)
+updater_id = config.UPDATER_ID or f'{socket.gethostname()}:{os.getpid()}'
+claims = itertools.count(1)
+# ids of the jobs this updater holds, from their claim until they are delivered or handed back
+in_flight = set()
+token_pool = TokenPool(config.CAPTCHA_POOL_SIZE, config.CAPTCHA_POOL_MAX, config.CAPTCHA_TOKEN_TTL)
+stats.register('captcha', token_pool.stats)
+stats.register('lalalai', lalalai.governor.stats)
+stats.register('capsolver', capsolver.governor.stats)
+stats.register('workspace', workspace.stats)
+stats.register('http', http.stats)
+stats.register('downloads', lambda: {**lalalai.download_stats, 'bytes_per_second': round(
+    lalalai.download_stats['bytes'] / (lalalai.download_stats['seconds'] or 1))})
+stats.register('delivery', lambda: {**utils.delivery_stats, 'queued': deliveries.qsize()})
+stats.register('polling', lambda: {'processing_time': lalalai.processing_time.value,
+                                   'captcha_time': capsolver.solve_time.value})
+
+
+class PartError(Exception):
+    pass
+
+
+async def cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def process_part(file_id, part, stem, level, session, tokens, checker, checkpoint):
+    filename = media.original_part_name(file_id, part)
+    state, lalal_id, attempts = checkpoint
+    api = LalalaiApi(workspace.path(file_id, 'original_parts', filename), stem, level, session)
+    if state == 'processing' and lalal_id:  # uploaded and sent for separation before a restart
+        api.id = lalal_id
+    else:
+        captcha = asyncio.create_task(tokens.get())
+        try:
+            await api.upload_file()
+            if not api.success:
+                raise PartError(api.error or 'upload failed')
+            logging.debug(f'File {filename} uploaded')
+            await checkpoints.set_part(file_id, part, 'uploaded', api.id)
+            api.captcha = await captcha
+        except BaseException:
+            if captcha.done() and not captcha.cancelled() and captcha.exception() is None:
+                tokens.put_back(captcha.result())  # solved but not used, the retry or another part takes it
+            raise
+        finally:
+            captcha.cancel()
         await api.process()
-        logging.debug(f'File {filename} processed')
-        while api.success and not api.audio:
-            await api.check()
-            logging.debug(f'File {filename} checked')
-            await asyncio.sleep(3)
         if not api.success:
-            logging.error(f'Error in file {filename}: {api.error}')
-            raise FileNotFoundError
-        await api.download()
-        logging.debug(f'File {filename} downloaded')
-    except FileNotFoundError:
-        logging.error(f'File not found')
-        utils.set_audiofile_status(file_id, 'error')
-        raise
-    except TimeoutError:
-        logging.error(f'Timeout error')
+            raise PartError(api.error)
+        logging.debug(f'File {filename} processed')
+        await checkpoints.set_part(file_id, part, 'processing', api.id)
+    try:
+        await checker.wait(api)
+    except (TimeoutError, asyncio.TimeoutError, ClientError):
         raise
+    except Exception as e:  # a malformed check answer
+        raise PartError(f'Error checking {filename}: {e!r}') from e
+    logging.debug(f'File {filename} checked')
+    if not api.success:
+        raise PartError(api.error)
+    result_parts = workspace.dir(file_id, 'result_parts')
+    await api.download(result_parts)
+    if not api.success:
+        raise PartError(api.error)
+    logging.debug(f'File {filename} downloaded')
+    try:  # decoded while other parts are still processing, the merge decodes whatever is missing
+        await media.premerge(result_parts / 'stem', result_parts / 'no_stem', api.result_filename)
+    except ffmpeg.Error as e:
+        logging.warning(f'Error decoding {filename} ahead of the merge: {e.stderr.decode("utf-8")}')
+    await checkpoints.set_part(file_id, part, 'downloaded')
+
+
+async def split_part(file_id, original, original_parts, part):
+    # a part that fails to cut fails like any other part, the job is retried
+    try:
+        return await media.split_part(file_id, original, original_parts, part)
+    except ffmpeg.Error as e:
+        raise PartError(f'Error splitting part {part}: {e.stderr.decode("utf-8")}') from e
+
+
+async def separate_part(file_id, part, stem, level, session, tokens, checker, checkpoint, split=None):
+    if split is not None:  # pipelined split, the part goes up as soon as it is cut
+        await split
+    attempts = 0  # counted per run, the checkpoint keeps the total over all runs
+    backoff = Backoff(config.POLL_MIN_INTERVAL, config.POLL_MAX_INTERVAL)
+    while True:
+        try:
+            return await process_part(file_id, part, stem, level, session, tokens, checker, checkpoint)
+        except (PartError, TimeoutError, asyncio.TimeoutError, ClientError) as e:
+            attempts += 1
+            logging.error(f'Error in part {part} of file {file_id}, attempt {attempts}: {e!r}')
+            await checkpoints.set_part(file_id, part, 'failed', error=repr(e), failed=True)
+            if attempts >= config.PART_ATTEMPTS:
+                raise
+            checkpoint = ('failed', None, attempts)
+            await asyncio.sleep(backoff.next())
 
 
-async def update_audio():
-    with DatabaseConnection() as db:
+async def claim_audio(limit):
+    # the conditional update is atomic, so concurrent updaters never claim the same job,
+    # jobs whose worker died are reclaimed once their lease expires
+    async with DatabaseConnection() as db:
         conn, cursor = db
-        cursor.execute('SELECT a.id, users.user_id, a.title, a.stem, a.level '
-                       'FROM audiofiles AS a '
-                       'INNER JOIN users ON users.id = a.user_id '
-                       'WHERE a.status=\'await\'')
-        result = cursor.fetchall()
-    logging.debug(f'Audio files to update: {len(result)}')
-    for res in result:
-        file_id, user_id, title, stem, level = res
+        # jobs coalesced onto a parent that finished before they were queued run on their own
+        await cursor.execute('UPDATE audiofiles AS c '
+                             'INNER JOIN audiofiles AS p ON p.id = c.parent_id '
+                             'SET c.parent_id=NULL '
+                             'WHERE c.status=\'await\' AND p.status IN (\'error\', \'complete\', \'cleared\')')
+        # only the rows taken by this update are read back, not the ones still running from earlier claims
+        token = f'{updater_id}:{next(claims)}'
+        await cursor.execute('UPDATE audiofiles '
+                             'SET status=\'processing\', claimed_by=%s, claim_token=%s, '
+                             'lease_until=NOW() + INTERVAL %s SECOND '
+                             'WHERE (status=\'await\' AND parent_id IS NULL '
+                             'AND (lease_until IS NULL OR lease_until < NOW())) '
+                             'OR (status=\'processing\' AND lease_until < NOW()) '
+                             'ORDER BY id LIMIT %s',
+                             [updater_id, token, config.UPDATER_LEASE, limit])
+        await cursor.execute('SELECT a.id, users.user_id, a.title, a.stem, a.level, a.file_unique_id, '
+                             'a.stage, a.parts, a.content_hash, a.attempts '
+                             'FROM audiofiles AS a '
+                             'INNER JOIN users ON users.id = a.user_id '
+                             'WHERE a.status=\'processing\' AND a.claim_token=%s',
+                             [token])
+        result = await cursor.fetchall()
+    logging.debug(f'Audio files claimed: {len(result)}')
+    return result
+
+
+async def renew_leases(file_ids):
+    # only jobs still held by the pool, one left 'processing' by a failed delivery lapses and is redelivered
+    if not file_ids:
+        return
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('UPDATE audiofiles SET lease_until=NOW() + INTERVAL %s SECOND '
+                             f'WHERE status=\'processing\' AND claimed_by=%s AND id IN ({", ".join(["%s"] * len(file_ids))})',
+                             [config.UPDATER_LEASE, updater_id, *file_ids])
+
+
+async def release_audio(file_ids):
+    if not file_ids:
+        return
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('UPDATE audiofiles SET status=\'await\', claimed_by=NULL, lease_until=NULL '
+                             f'WHERE status=\'processing\' AND claimed_by=%s AND id IN ({", ".join(["%s"] * len(file_ids))})',
+                             [updater_id, *file_ids])
+
+
+async def finish_children(file_id, result):
+    # deliver to the jobs coalesced onto this one, or let them run on their own if it failed
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        if result is None:
+            await cursor.execute('UPDATE audiofiles SET parent_id=NULL WHERE parent_id=%s AND status=\'await\'',
+                                 [file_id])
+            return
+        await cursor.execute('SELECT a.id, users.user_id, a.title '
+                             'FROM audiofiles AS a '
+                             'INNER JOIN users ON users.id = a.user_id '
+                             'WHERE a.parent_id=%s AND a.status=\'await\'',
+                             [file_id])
+        children = await cursor.fetchall()
+    for child_id, user_id, title in children:
+        # sent by the file ids of the first delivery, nothing is uploaded again
+        if await utils.send_result(user_id, title, result):
+            await utils.save_delivery(child_id, result)
+        await utils.set_audiofile_status(child_id, 'complete')
+
+
+async def fail_audio(file_id):
+    await utils.set_audiofile_status(file_id, 'error')
+    await finish_children(file_id, None)
+
+
+async def retry_audio(file_id, attempts):
+    # checkpoints and files are kept, the next claim resumes only the missing work
+    if attempts + 1 >= config.JOB_ATTEMPTS:
+        return await fail_audio(file_id)
+    # handed back before it is claimable, so the next claim is not rejected as a job still running;
+    # on an 'await' job the lease holds it back until the retry delay has passed
+    in_flight.discard(file_id)
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('UPDATE audiofiles SET status=\'await\', attempts=attempts + 1, '
+                             'claimed_by=NULL, lease_until=NOW() + INTERVAL %s SECOND WHERE id=%s',
+                             [config.JOB_RETRY_DELAY * 2 ** attempts, file_id])
+
+
+# finished jobs waiting for their upload to telegram, sent by the delivery workers
+deliveries = asyncio.Queue(config.DELIVERY_QUEUE_SIZE)
+
 
-        utils.recompile_file(file_id)
+async def complete_audio(file_id, user_id, title, result: Result) -> bool:
+    # the job stays in flight with its lease renewed until the delivery is done,
+    # a crash before it redelivers from the merged stage
+    await deliveries.put((file_id, user_id, title, result))
+    return True
 
-        parts = utils.split_file(file_id, files_dir / 'original' / f'{file_id}.mp3')
+
+async def deliver(file_id, user_id, title, result: Result):
+    uploaded = result.uploaded
+    if await utils.send_result(user_id, title, result):
+        await utils.save_delivery(file_id, result)
+        if not uploaded:
+            await result_cache.set_file_ids(result)
+    await checkpoints.set_stage(file_id, 'delivered')
+    await utils.set_audiofile_status(file_id, 'complete')
+    await finish_children(file_id, result)
+
+
+def parts_exist(folder, file_id, parts, name=media.part_name) -> bool:
+    return all((folder / name(file_id, part)).exists() for part in range(parts))
+
+
+def job_paths(file_id):
+    # spilling moves the job directory, so paths are taken again after every spill
+    workspace.spill(file_id)
+    return (workspace.dir(file_id, 'original_parts'),
+            workspace.dir(file_id, 'result_parts', 'stem'),
+            workspace.dir(file_id, 'result_parts', 'no_stem'),
+            workspace.path(file_id, 'result', 'stem.mp3'),
+            workspace.path(file_id, 'result', 'no_stem.mp3'))
+
+
+async def update_audio(file_id, user_id, title, stem, level, file_unique_id, stage, parts, content_hash, attempts):
+    original_parts, result_parts_stem, result_parts_no_stem, result_stem, result_no_stem = job_paths(file_id)
+
+    if reached(stage, 'delivered'):
+        await utils.set_audiofile_status(file_id, 'complete')
+        return
+
+    pipelined, splits = False, {}
+    if not reached(stage, 'split') or not parts_exist(original_parts, file_id, parts, media.original_part_name):
+        hit = await result_cache.lookup(stem, level, file_unique_id=file_unique_id)
+        if hit is not None:
+            return await complete_audio(file_id, user_id, title, hit)
+
+        previous, original = parts, workspace.path(file_id, 'original.mp3')
+        # a job past the split that lost its original parts is split again in one pass, its parts are separated
+        pipelined = config.SPLIT_PIPELINE and not reached(stage, 'split')
+        if pipelined:
+            parts, content_hash = await media.count_parts(original)
+        else:
+            parts, content_hash = await media.split(file_id, original, original_parts)
+
+        hit = await result_cache.lookup(stem, level, content_hash=content_hash)
+        if hit is not None:
+            return await complete_audio(file_id, user_id, title, hit)
 
         if not parts:
             logging.error(f'Error splitting file {file_id}: no parts')
-            utils.set_audiofile_status(file_id, 'error')
-            continue
-
-        files = [f'{file_id}_{part}.mp3' for part in range(parts)]
-        logging.debug(f'File parts to upload: {parts}, {files}')
+            await fail_audio(file_id)
+            return
+        if parts != previous:  # the same upload is always cut into the same parts, their paid work stays valid
+            await checkpoints.reset_parts(file_id)
+        if pipelined:
+            # the part count is kept at once, so a retry before the split checkpoint still knows its parts
+            await checkpoints.set_stage(file_id, stage, parts)
+        else:
+            await checkpoints.set_stage(file_id, 'split', parts, content_hash)
+            stage = 'split'
+            original_parts, result_parts_stem, result_parts_no_stem, result_stem, result_no_stem = job_paths(file_id)
 
-        try:
-            async with ClientSession(headers=base_headers, timeout=ClientTimeout(total=10)) as session:
-                await asyncio.gather(*(
-                    asyncio.create_task(
-                        process_files(file, file_id, stem, level, session)
-                    ) for file in files))
-        except (FileNotFoundError, TimeoutError):
-            continue
+    separated = parts_exist(result_parts_stem, file_id, parts) and parts_exist(result_parts_no_stem, file_id, parts)
+    if not reached(stage, 'separated') or not separated or pipelined:
+        done = await checkpoints.load_parts(file_id)
+        todo = [part for part in range(parts)
+                if done.get(part, ('pending',))[0] != 'downloaded'
+                or not (result_parts_stem / media.part_name(file_id, part)).exists()
+                or not (result_parts_no_stem / media.part_name(file_id, part)).exists()]
+        logging.debug(f'File parts to upload: {todo} of {parts}')
+        session = http.get_session()
+        checker = LalalaiChecker(session)
+        if pipelined:
+            # every missing part is cut by its own ffmpeg and separated as soon as it is written,
+            # the split checkpoint is set once all of them are
+            splits = {part: asyncio.create_task(split_part(file_id, original, original_parts, part)) for part in todo}
+        with token_pool.reserve(len(todo)) as tokens:
+            tasks = [asyncio.create_task(separate_part(
+                file_id, part, stem, level, session, tokens, checker, done.get(part, ('pending', None, 0)),
+                splits.get(part)
+            )) for part in todo]
+            pending = [*tasks, *splits.values()]
+            try:
+                if pipelined:
+                    await asyncio.gather(*splits.values())
+                    await checkpoints.set_stage(file_id, 'split', parts, content_hash)
+                await asyncio.gather(*tasks)
+            except BaseException as e:
+                # parts still running keep their checkpoints for the next attempt
+                await cancel(pending)
+                if not isinstance(e, (PartError, TimeoutError, asyncio.TimeoutError, ClientError)):
+                    raise
+                await retry_audio(file_id, attempts)
+                return
+        await checkpoints.set_stage(file_id, 'separated')
+        stage = 'separated'
+        original_parts, result_parts_stem, result_parts_no_stem, result_stem, result_no_stem = job_paths(file_id)
 
-        result_stem = ensure_dir(files_dir / 'result' / 'stem') / f'{file_id}.mp3'
-        result_no_stem = ensure_dir(files_dir / 'result' / 'no_stem') / f'{file_id}.mp3'
-        result_parts_stem = ensure_dir(files_dir / 'result_parts' / 'stem')
-        result_parts_no_stem = ensure_dir(files_dir / 'result_parts' / 'no_stem')
+    files = [media.part_name(file_id, part) for part in range(parts)]
 
+    if not reached(stage, 'merged') or not result_stem.exists() or not result_no_stem.exists():
         try:
-            utils.crossfade_merge(result_parts_stem, files, title, result_stem)
-            utils.crossfade_merge(result_parts_no_stem, files, title, result_no_stem)
+            duration = await media.merge(result_parts_stem, result_parts_no_stem, files, title,
+                                         result_stem, result_no_stem)
         except Exception as e:
             logging.error(f'Error merging files: {e}')
             if isinstance(e, ffmpeg.Error):
                 logging.error(f'Error output: {e.stderr.decode("utf-8")}')
-            utils.set_audiofile_status(file_id, 'error')
-            continue
+            await fail_audio(file_id)
+            return
+        await checkpoints.set_stage(file_id, 'merged')
+    else:
+        duration = await media.duration(result_stem)
+    duration = int(duration)
+    logging.debug(f'Result duration: {duration}, workspace usage: {workspace.usage(file_id)} bytes')
 
-        duration = int(float(ffmpeg.probe(result_stem, ffprobe_cmd)['format']['duration']))
-        logging.debug(f'Result duration: {duration}')
+    result = Result(result_stem, result_no_stem, duration)
+    if not reached(stage, 'merged'):  # a job resumed past the merge stored its result in that earlier run
+        await result_cache.store(stem, level, file_unique_id, content_hash, result)
+    return await complete_audio(file_id, user_id, title, result)
 
-        try:
-            await bot.send_chat_action(user_id, enums.ChatAction.UPLOAD_DOCUMENT)
-            await bot.send_audio(user_id, types.FSInputFile(result_stem, filename=title),
-                                 duration=duration, title=title, caption='With stem')
-            await bot.send_chat_action(user_id, enums.ChatAction.UPLOAD_DOCUMENT)
-            await bot.send_audio(user_id, types.FSInputFile(result_no_stem, filename=title),
-                                 duration=duration, title=title, caption='No stem')
-        except exceptions.TelegramAPIError as e:
-            logging.error(f'Error sending audio: {e}')
-        except Exception as e:
-            logging.error(f'Error: {e}')
-        utils.set_audiofile_status(file_id, 'complete')
+
+async def run_audio(file_id, *job):
+    # an error no stage handles still counts as a failed attempt, so a job that keeps failing ends at JOB_ATTEMPTS
+    try:
+        return await update_audio(file_id, *job)
+    except Exception:
+        await retry_audio(file_id, job[-1])
+        raise
 
 
 async def clear_audio():
-    def remove_parts(file_id_, parts_dir_):
-        for part in parts_dir_.iterdir():
-            if part.name.startswith(f'{file_id_}_'):
-                part.unlink(missing_ok=True)
-
-    with DatabaseConnection() as db:
+    async with DatabaseConnection() as db:
         conn, cursor = db
-        cursor.execute('SELECT a.id FROM audiofiles AS a WHERE status IN (\'error\', \'complete\')')
-        result = cursor.fetchall()
+        await cursor.execute('SELECT a.id FROM audiofiles AS a WHERE status IN (\'error\', \'complete\')')
+        result = await cursor.fetchall()
     logging.debug(f'Audio files to clear: {len(result)}')
     for res in result:
         file_id = res[0]
+        logging.debug(f'Clearing workspace of file {file_id}')
+        workspace.remove(file_id)
+        await utils.set_audiofile_status(file_id, 'cleared')
+
+
+async def active_jobs(ids):
+    if not ids:
+        return set()
+    async with DatabaseConnection() as db:
+        conn, cursor = db
+        await cursor.execute('SELECT id FROM audiofiles WHERE status IN (\'init\', \'await\', \'processing\') '
+                             f'AND id IN ({", ".join(["%s"] * len(ids))})',
+                             ids)
+        return {row[0] for row in await cursor.fetchall()}
+
+
+async def remove_legacy():
+    # jobs still running from before the upgrade keep their files, moved into their job directories
+    ids = sorted({file_id for file_id, *_ in workspace.legacy_files(files_dir)})
+    workspace.remove_legacy(files_dir, await active_jobs(ids))
+
+
+async def collect_garbage() -> int:
+    """
+    Reclaim job directories without an active job, untouched ones after WORKSPACE_ORPHAN_AGE
+    and the oldest ones first while the workspace is above the high watermark
+
+    :return: bytes used by the workspace afterwards
+    """
+    jobs = workspace.jobs()
+    active = {str(file_id) for file_id in await active_jobs([int(name) for name, *_ in jobs if name.isdigit()])}
+    now = time()
+    used = sum(size for *_, size, _ in jobs)
+    # hysteresis: once above the high watermark reclaim down to the low one
+    target = config.WORKSPACE_LOW_WATERMARK if used > config.WORKSPACE_HIGH_WATERMARK else None
+    reclaimed = 0
+    for name, path, place, size, mtime in sorted(jobs, key=lambda job: job[4]):
+        if name in active or now - mtime < 60:  # a minute of grace for directories being filled right now
+            continue
+        if now - mtime >= config.WORKSPACE_ORPHAN_AGE or (target is not None and used > target):
+            shutil.rmtree(path, ignore_errors=True)
+            used -= size
+            reclaimed += 1
+    if reclaimed:
+        logging.warning(f'Workspace garbage collection reclaimed {reclaimed} directories, {used} bytes in use')
+    return used
+
+
+class JobPool:
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.in_flight = in_flight
+        self.stopping = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.workspace_used = 0
+
+    def submit(self, job) -> bool:
+        file_id = job[0]
+        if file_id in self.in_flight or self.queue.full():
+            return False
+        self.in_flight.add(file_id)
+        self.queue.put_nowait(job)
+        return True
+
+    async def enqueue_audio(self):
+        free = self.queue.maxsize - self.queue.qsize()
+        if free <= 0:
+            return
+        # no intake while a service is down, the breaker lets a probe through once it half-opens
+        for breaker in (lalalai.breaker, capsolver.breaker):
+            if breaker.is_open:
+                logging.warning(f'Circuit {breaker.name} is open, pausing job intake')
+                asyncio.get_running_loop().call_later(breaker.reset_timeout, self.notify)
+                return
+        # active jobs alone are above the watermark, let them finish before taking new ones
+        if self.workspace_used > config.WORKSPACE_HIGH_WATERMARK:
+            logging.warning(f'Workspace uses {self.workspace_used} bytes, pausing job intake')
+            return
+        for job in await claim_audio(free):
+            self.submit(job)
+        token_pool.set_backlog(self.queue.qsize())
 
-        # clear original files
-        logging.debug(f'Clearing original file {file_id}')
-        original = ensure_dir(files_dir / 'original') / f'{file_id}.mp3'
-        original.unlink(missing_ok=True)
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(config.UPDATER_LEASE / 3)
+            await utils.exec_protected(renew_leases, list(self.in_flight))
 
-        logging.debug(f'Clearing original parts for file {file_id}')
-        remove_parts(file_id, ensure_dir(files_dir / 'original_parts'))
+    async def collect_garbage(self):
+        await utils.exec_protected(remove_legacy)
+        while True:
+            used = await utils.exec_protected(collect_garbage)
+            if used is not None:
+                was_full, self.workspace_used = self.workspace_used > config.WORKSPACE_HIGH_WATERMARK, used
+                if was_full and used <= config.WORKSPACE_HIGH_WATERMARK:
+                    self.notify()
+            await asyncio.sleep(config.WORKSPACE_GC_INTERVAL)
 
-        # clear result files
-        logging.debug(f'Clearing result files for file {file_id}')
-        result_stem = ensure_dir(files_dir / 'result' / 'stem') / f'{file_id}.mp3'
-        result_stem.unlink(missing_ok=True)
-        result_no_stem = ensure_dir(files_dir / 'result' / 'no_stem') / f'{file_id}.mp3'
-        result_no_stem.unlink(missing_ok=True)
+    def notify(self, file_id=None):
+        logging.debug(f'Woken up by {file_id or "a finished job"}')
+        self.wakeup.set()
 
-        logging.debug(f'Clearing result parts for file {file_id}')
-        remove_parts(file_id, ensure_dir(files_dir / 'result_parts' / 'stem'))
-        remove_parts(file_id, ensure_dir(files_dir / 'result_parts' / 'no_stem'))
+    async def poll(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            await utils.exec_protected(self.enqueue_audio)
+            await utils.exec_protected(clear_audio)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), config.UPDATER_POLL_INTERVAL)
 
-        utils.set_audiofile_status(file_id, 'cleared')
+    async def deliver(self):
+        while True:
+            job = await deliveries.get()
+            try:
+                await utils.exec_protected(deliver, *job)
+            finally:
+                self.in_flight.discard(job[0])
+                deliveries.task_done()
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            token_pool.set_backlog(self.queue.qsize())
+            delivering = False
+            try:
+                # a job handed to the delivery workers stays in flight until it is sent
+                delivering = await utils.exec_protected(run_audio, *job)
+            finally:
+                if not delivering:
+                    self.in_flight.discard(job[0])
+                self.queue.task_done()
+                self.notify()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    async def drain(self):
+        # jobs that have not started go back to 'await' for the next start or another updater
+        released = []
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            self.in_flight.discard(job[0])
+            self.queue.task_done()
+            released.append(job[0])
+        await utils.exec_protected(release_audio, released)
+        await self.queue.join()
+        await deliveries.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def run(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self.tasks.extend(asyncio.create_task(self.deliver()) for _ in range(config.DELIVERY_WORKERS))
+        self.tasks.append(asyncio.create_task(self.heartbeat()))
+        self.tasks.append(asyncio.create_task(token_pool.run()))
+        self.tasks.append(asyncio.create_task(self.collect_garbage()))
+        self.tasks.append(asyncio.create_task(stats.dump_periodically(files_dir / 'updater_stats.json',
+                                                                      config.UPDATER_STATS_INTERVAL)))
+        await self.poll()
+        logging.warning(f'Stopping, waiting for {len(self.in_flight)} jobs to finish')
+        await self.drain()
 
 
 async def main():
-    executable = (update_audio, clear_audio)
-    while True:
-        for exe in executable:
-            await utils.exec_protected(exe)
-        await asyncio.sleep(5)
+    pool = JobPool(config.UPDATER_WORKERS, config.UPDATER_QUEUE_SIZE)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, pool.stop)
+    server = await serve_notifications(pool.notify)
+    await pool.run()
+    if server is not None:
+        server.close()
+    await http.close_session()
+    await close_pool()
 
 
 if __name__ == '__main__':
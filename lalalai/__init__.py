@@ -1,7 +1,17 @@
+import os
+import asyncio
+import logging
 import aiofiles
+from time import monotonic
+from pathlib import Path
+from aiohttp import ClientError
 
-from app.misc import files_dir
+from app import config
 from app.utils.file import ensure_dir
+from app.utils.circuit import CircuitBreaker
+from app.utils import http
+from app.utils.governor import Governor
+from app.utils.polling import Backoff, DurationEstimate
 from .audio import Audio
 
 
@@ -31,12 +41,42 @@ ENHANCE = {
     Audio.WIND: 'false',
 }
 
+API_URL = 'https://www.lalal.ai/api'
+
+# shared by every job of the process, so concurrent jobs can't flood lalal.ai
+breaker = CircuitBreaker('lalalai', config.BREAKER_FAILURES, config.BREAKER_ERROR_RATE,
+                         config.BREAKER_WINDOW, config.BREAKER_RESET_TIMEOUT)
+governor = Governor('lalalai', config.LALALAI_RATE, config.LALALAI_BURST, 1, config.LALALAI_MAX_CONCURRENCY,
+                    breaker=breaker)
+
+
+# read size of the streamed upload body
+UPLOAD_BLOCK_SIZE = 256 * 1024
+
+
+# downloaded result parts, in the updater stats
+download_stats = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'resumes': 0, 'failures': 0}
+
+
+def parts_count(size: int) -> int:
+    return max(1, size // config.UPLOAD_PART_SIZE)
+
+
+async def post(session, path, data):
+    async with governor.slot(path) as call:
+        res = await session.post(API_URL + path, data=data)
+        call.ok = res.status < 500 and res.status != 429
+        res = await res.json()
+        call.ok = call.ok and res.get('status') == 'success'
+    return res
+
 
 class Api:
-    def __init__(self, filename: str, stem: str, level: int = 1, session=None, captcha=None):
-        self.api_url = 'https://www.lalal.ai/api'
-        self.filename = filename
-        self.filepath = files_dir / 'original_parts' / filename
+    def __init__(self, filepath: Path, stem: str, level: int = 1, session=None, captcha=None):
+        self.api_url = API_URL
+        self.filename = filepath.name
+        self.filepath = filepath
+        self.result_filename = filepath.with_suffix('.mp3').name  # previews are mp3 whatever was uploaded
         self.stem = stem
         self.level = level
         self.id = None
@@ -55,16 +95,16 @@ class Api:
             self.success = False
             self.error = res['error']
         if self.id is not None and 'result' in res:
-            task = res['result'][self.id]['task']
-            if task['state'] == 'error':
+            task = res['result'].get(self.id, {}).get('task') or {}
+            if task.get('state') == 'error':
                 self.success = False
                 self.error = task['error']
 
     async def upload_file(self):
-        url = await self._create_upload()
-        if not url:
+        urls = await self._create_upload()
+        if not urls:
             return
-        await self._upload_file(url)
+        await self._upload_file(urls)
         if not self.success:
             return
         await self._complete_upload()
@@ -72,30 +112,59 @@ class Api:
     async def _create_upload(self):
         data = {
             'file_name': self.filename,
-            'parts_count': 1
+            'parts_count': parts_count(os.path.getsize(self.filepath))
         }
-        res = await self.session.post(self.api_url + '/upload/multipart/create/', data=data)
-        res = await res.json()
+        res = await post(self.session, '/upload/multipart/create/', data)
         self.handle_response(res)
         if not self.success:
             return None
         self.id = res['file_id']
         self.upload_id = res['upload_id']
-        return res['upload_urls'][0]
+        return res['upload_urls']
 
-    async def _upload_file(self, upload_url):
-        headers = {'content-type': ''}
-        with open(self.filepath, 'rb') as f:
-            res = await self.session.put(upload_url, data=f, headers=headers, timeout=60)
-        self.success = res.status == 200
+    async def _upload_file(self, upload_urls):
+        # every chunk but the last holds at least UPLOAD_PART_SIZE bytes, all chunks go up in parallel
+        size = os.path.getsize(self.filepath)
+        chunk = -(-size // len(upload_urls))
+        results = await asyncio.gather(*(self._upload_chunk(url, part * chunk, min(chunk, size - part * chunk))
+                                         for part, url in enumerate(upload_urls)))
+        self.success = all(results)
+
+    async def _read_chunk(self, offset: int, length: int):
+        async with aiofiles.open(self.filepath, 'rb') as f:
+            await f.seek(offset)
+            while length > 0:
+                block = await f.read(min(UPLOAD_BLOCK_SIZE, length))
+                if not block:
+                    return
+                length -= len(block)
+                yield block
+
+    async def _upload_chunk(self, upload_url, offset: int, length: int) -> bool:
+        # a known length keeps aiohttp from chunked encoding, which presigned urls refuse
+        headers = {'content-type': '', 'content-length': str(length)}
+        backoff = Backoff(1, 10)
+        for attempt in range(1, config.UPLOAD_ATTEMPTS + 1):
+            try:
+                async with governor.slot('upload') as call:
+                    async with self.session.put(upload_url, data=self._read_chunk(offset, length),
+                                                headers=headers, timeout=http.TRANSFER_TIMEOUT) as res:
+                        call.ok = res.status == 200
+                if call.ok:
+                    return True
+                logging.warning(f'Upload of {self.filename} at {offset} failed with {res.status}, attempt {attempt}')
+            except (ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f'Upload of {self.filename} at {offset} failed: {e!r}, attempt {attempt}')
+            if attempt < config.UPLOAD_ATTEMPTS:
+                await asyncio.sleep(backoff.next())
+        return False
 
     async def _complete_upload(self):
         data = {
             'file_id': self.id,
             'upload_id': self.upload_id
         }
-        res = await self.session.post(self.api_url + '/upload/multipart/complete/', data=data)
-        res = await res.json()
+        res = await post(self.session, '/upload/multipart/complete/', data)
         self.handle_response(res)
 
     async def process(self):
@@ -109,31 +178,161 @@ class Api:
             'with_segments': 'false',
             'turnstile-response': self.captcha
         }
-        res = await self.session.post(self.api_url + '/preview/', data=data)
-        res = await res.json()
+        res = await post(self.session, '/preview/', data)
         self.handle_response(res)
 
     async def check(self):
         data = {'id': self.id}
-        res = await self.session.post(self.api_url + '/check/', data=data)
-        res = await res.json()
+        res = await post(self.session, '/check/', data)
+        self.handle_check(res)
+
+    def handle_check(self, res):
         self.handle_response(res)
         if not self.success:
             return
-        preview = res['result'][self.id]['preview']
+        preview = res['result'].get(self.id, {}).get('preview')
         if not preview:
             return
         self.audio.stem = preview['stem_track']
         self.audio.no_stem = preview['back_track']
 
-    async def _download(self, url, filename):
-        async with self.session.get(url) as res:
-            async with aiofiles.open(filename, 'wb') as f:
-                while chunk := await res.content.read(1024):
-                    await f.write(chunk)
+    async def _fetch(self, url, partial: Path):
+        """
+        Append the rest of the file to partial, resuming with a Range request when it is not empty
+
+        :return: expected size of the whole file, None when the server does not tell
+        """
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        async with governor.slot('download') as call, self.session.get(url, headers=headers,
+                                                                     timeout=http.TRANSFER_TIMEOUT) as res:
+            call.ok = res.status in (200, 206)
+            if res.status == 416:  # nothing left to fetch, the length check decides
+                return offset
+            res.raise_for_status()
+            if res.status == 206:
+                download_stats['resumes'] += 1
+                total = res.headers.get('Content-Range', '').rpartition('/')[2]
+                expected = int(total) if total.isdigit() else None
+            else:  # the range was ignored, start over
+                offset = 0
+                expected = res.content_length
+            async with aiofiles.open(partial, 'ab' if offset else 'wb') as f:
+                # large buffered writes instead of a thread hop per network chunk
+                buffer = bytearray()
+                try:
+                    async for chunk in res.content.iter_chunked(config.DOWNLOAD_BUFFER_SIZE):
+                        buffer += chunk
+                        if len(buffer) >= config.DOWNLOAD_BUFFER_SIZE:
+                            await f.write(buffer)
+                            buffer.clear()
+                finally:  # keep what arrived before a dropped connection for the resume
+                    if buffer:
+                        await f.write(buffer)
+        return expected
+
+    async def _download(self, url, path: Path) -> bool:
+        # the file only gets its final name once its length is verified, so the merge never sees a short file
+        partial = path.with_name(path.name + '.part')
+        backoff = Backoff(1, 10)
+        start = monotonic()
+        for attempt in range(1, config.DOWNLOAD_ATTEMPTS + 1):
+            try:
+                expected = await self._fetch(url, partial)
+                size = partial.stat().st_size
+                if expected is None or size == expected:
+                    partial.replace(path)
+                    elapsed = monotonic() - start
+                    download_stats['files'] += 1
+                    download_stats['bytes'] += size
+                    download_stats['seconds'] += elapsed
+                    logging.debug(f'Downloaded {path.name}: {size} bytes in {elapsed:.1f}s')
+                    return True
+                logging.warning(f'Download of {path.name} has {size} of {expected} bytes, attempt {attempt}')
+                if size > expected:
+                    partial.unlink()
+            except (ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f'Download of {path.name} failed: {e!r}, attempt {attempt}')
+            if attempt < config.DOWNLOAD_ATTEMPTS:
+                await asyncio.sleep(backoff.next())
+        download_stats['failures'] += 1
+        return False
+
+    async def download(self, folder: Path):
+        results = await asyncio.gather(
+            self._download(self.audio.stem, ensure_dir(folder / 'stem') / self.result_filename),
+            self._download(self.audio.no_stem, ensure_dir(folder / 'no_stem') / self.result_filename),
+        )
+        if not all(results):
+            self.success = False
+            self.error = 'download failed'
+
+
+# time from preview request to a ready result, learned from finished parts
+processing_time = DurationEstimate(config.POLL_EXPECTED_TIME)
+
+
+class Checker:
+    """
+    Polls all outstanding parts of a job with one /check/ request per tick
+
+    Sleeps until the earliest part is expected to be ready, then backs off with jitter.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.pending = {}
+        self.backoff = Backoff(config.POLL_MIN_INTERVAL, config.POLL_MAX_INTERVAL)
+        self.task = None
+        self.requests = 0
+
+    async def wait(self, api: Api):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[api.id] = (api, future, monotonic())
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        try:
+            await future
+        finally:
+            self.pending.pop(api.id, None)
+
+    def delay(self) -> float:
+        expected = min(started for _, _, started in self.pending.values()) + processing_time.value
+        if expected > monotonic():
+            self.backoff.reset()
+            return max(expected - monotonic(), config.POLL_MIN_INTERVAL)
+        return self.backoff.next()
 
-    async def download(self):
-        folder = files_dir / 'result_parts'
+    def expire(self):
+        # parts that never get ready fail instead of being checked forever
+        for api, future, started in list(self.pending.values()):
+            if not future.done() and monotonic() - started > config.POLL_MAX_AGE:
+                future.set_exception(TimeoutError(f'File {api.id} not processed in {config.POLL_MAX_AGE} seconds'))
 
-        await self._download(self.audio.stem, ensure_dir(folder / 'stem') / self.filename)
-        await self._download(self.audio.no_stem, ensure_dir(folder / 'no_stem') / self.filename)
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(self.delay())
+            self.expire()
+            pending = [entry for entry in self.pending.values() if not entry[1].done()]
+            if not pending:
+                continue
+            try:
+                res = await post(self.session, '/check/', {'id': ','.join(str(api.id) for api, _, _ in pending)})
+            except Exception as e:
+                logging.error(f'Error checking files: {e}')
+                continue
+            self.requests += 1
+            for api, future, started in pending:
+                if future.done():
+                    continue
+                try:  # a malformed answer fails its part only, the others keep waiting
+                    api.handle_check(res)
+                except Exception as e:
+                    logging.error(f'Error checking file {api.id}: {e!r}')
+                    future.set_exception(e)
+                    continue
+                if api.success and not api.audio:
+                    continue
+                if api.success:
+                    processing_time.update(monotonic() - started)
+                future.set_result(None)
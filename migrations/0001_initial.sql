@@ -1,4 +1,4 @@
-create table users
+create table if not exists users
 (
     id         int unsigned auto_increment
         primary key,
@@ -8,7 +8,7 @@ create table users
 )
     charset = latin1;
 
-create table audiofiles
+create table if not exists audiofiles
 (
     id         int unsigned auto_increment
         primary key,
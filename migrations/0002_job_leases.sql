@@ -0,0 +1,4 @@
+alter table audiofiles
+    modify status enum ('init', 'await', 'processing', 'error', 'complete', 'cleared') default 'init' not null,
+    add claimed_by  varchar(64) null after status,
+    add lease_until timestamp   null after claimed_by;
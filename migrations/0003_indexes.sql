@@ -0,0 +1,18 @@
+-- merge duplicate users created by concurrent first messages before adding the unique key
+update audiofiles
+    inner join users on users.id = audiofiles.user_id
+    inner join (select user_id, min(id) as id from users group by user_id) as keep on keep.user_id = users.user_id
+set audiofiles.user_id = keep.id
+where audiofiles.user_id <> keep.id;
+
+delete users
+from users
+    inner join (select user_id, min(id) as id from users group by user_id) as keep on keep.user_id = users.user_id
+where users.id <> keep.id;
+
+alter table users
+    add constraint users_user_id_uindex unique (user_id);
+
+alter table audiofiles
+    add index audiofiles_status_user_id_index (status, user_id),
+    add index audiofiles_status_lease_until_index (status, lease_until);
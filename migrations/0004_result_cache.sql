@@ -0,0 +1,25 @@
+alter table audiofiles
+    add file_unique_id varchar(64) null after title,
+    add parent_id      int unsigned null after level,
+    add index audiofiles_file_unique_id_index (file_unique_id, stem, level),
+    add constraint audiofile_parent_fk
+        foreign key (parent_id) references audiofiles (id)
+            on update cascade on delete set null;
+
+create table if not exists result_cache
+(
+    id             int unsigned auto_increment
+        primary key,
+    file_unique_id varchar(64)                           null,
+    content_hash   char(64)                              null,
+    stem           varchar(16)                           not null,
+    level          tinyint(1)                            not null,
+    duration       int unsigned                          not null,
+    size           bigint unsigned                       not null,
+    used_at        timestamp default current_timestamp() not null,
+    created_at     timestamp default current_timestamp() not null,
+    index result_cache_file_unique_id_index (file_unique_id, stem, level),
+    index result_cache_content_hash_index (content_hash, stem, level),
+    index result_cache_used_at_index (used_at)
+)
+    charset = latin1;
@@ -0,0 +1,21 @@
+alter table audiofiles
+    add stage        enum ('split', 'separated', 'merged', 'delivered') null after status,
+    add parts        tinyint unsigned                                   null after stage,
+    add content_hash char(64)                                           null after parts,
+    add attempts     tinyint unsigned default 0                         not null after content_hash;
+
+create table if not exists audiofile_parts
+(
+    audiofile_id int unsigned                                                              not null,
+    part         tinyint unsigned                                                          not null,
+    state        enum ('pending', 'uploaded', 'processing', 'downloaded', 'failed') default 'pending' not null,
+    lalal_id     varchar(64)                                                               null,
+    attempts     tinyint unsigned                    default 0                             not null,
+    error        varchar(256)                                                              null,
+    updated_at   timestamp default current_timestamp() on update current_timestamp()       not null,
+    primary key (audiofile_id, part),
+    constraint audiofile_parts_fk
+        foreign key (audiofile_id) references audiofiles (id)
+            on update cascade on delete cascade
+)
+    charset = latin1;
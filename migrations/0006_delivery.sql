@@ -0,0 +1,8 @@
+alter table audiofiles
+    add duration        int unsigned null after attempts,
+    add stem_file_id    varchar(255) null after duration,
+    add no_stem_file_id varchar(255) null after stem_file_id;
+
+alter table result_cache
+    add stem_file_id    varchar(255) null after size,
+    add no_stem_file_id varchar(255) null after stem_file_id;
@@ -0,0 +1,3 @@
+-- one token per claim, so an updater reads back only the rows its last claim took
+alter table audiofiles
+    add claim_token varchar(64) null after claimed_by;
@@ -0,0 +1,4 @@
+import os
+
+# app/__init__ creates the bot, any well-formed token will do for the tests
+os.environ.setdefault('TG_TOKEN', '123456789:test-token')
@@ -0,0 +1,91 @@
+import asyncio
+from app.utils.circuit import CircuitBreaker
+from app.utils.governor import Governor
+
+
+def open_breaker(reset_timeout: float = 0.05) -> CircuitBreaker:
+    breaker = CircuitBreaker('test', failures=2, error_rate=1, window=60, reset_timeout=reset_timeout)
+    breaker.record(False)
+    breaker.record(False)
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', failures=3, error_rate=1, window=60, reset_timeout=60)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened == 1
+
+
+def test_success_resets_consecutive_failures():
+    breaker = CircuitBreaker('test', failures=2, error_rate=1, window=60, reset_timeout=60)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_opens_on_error_rate():
+    breaker = CircuitBreaker('test', failures=100, error_rate=0.5, window=60, reset_timeout=60, min_calls=4)
+    for ok in (True, False, True, False):
+        breaker.record(ok)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_probe_closes_or_reopens():
+    async def run():
+        breaker = open_breaker()
+        await asyncio.sleep(0.06)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert await breaker.acquire() is True
+        breaker.record(False, probe=True)
+        assert breaker.state == CircuitBreaker.OPEN
+        await asyncio.sleep(0.06)
+        assert await breaker.acquire() is True
+        breaker.record(True, probe=True)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert await breaker.acquire() is False
+    asyncio.run(run())
+
+
+def test_released_probe_wakes_waiting_caller():
+    async def run():
+        breaker = open_breaker()
+        await asyncio.sleep(0.06)
+        assert await breaker.acquire() is True
+        waiting = asyncio.create_task(breaker.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        breaker.release_probe()
+        assert await asyncio.wait_for(waiting, 1) is True
+    asyncio.run(run())
+
+
+def test_cancelled_probe_wakes_waiting_caller():
+    async def run():
+        breaker = open_breaker()
+        governor = Governor('test', rate=1000, burst=10, min_limit=1, max_limit=4, breaker=breaker)
+        await asyncio.sleep(0.06)
+        started = asyncio.Event()
+
+        async def probe():
+            async with governor.slot():
+                started.set()
+                await asyncio.sleep(60)
+
+        async def caller():
+            async with governor.slot() as call:
+                return call
+
+        probing = asyncio.create_task(probe())
+        await started.wait()
+        waiting = asyncio.create_task(caller())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        probing.cancel()
+        await asyncio.wait_for(waiting, 1)
+        assert breaker.state == CircuitBreaker.CLOSED
+    asyncio.run(run())
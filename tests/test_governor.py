@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from app.utils.governor import Governor
+
+
+def governor(**kwargs) -> Governor:
+    return Governor('test', **{'rate': 1000, 'burst': 1000, 'min_limit': 1, 'max_limit': 16, **kwargs})
+
+
+def test_error_halves_limit_once_per_burst():
+    async def run():
+        governor_ = governor(initial_limit=8)
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                async with governor_.slot():
+                    raise RuntimeError
+        assert governor_.limit == 4
+        assert governor_.stats()['errors'] == 3
+        assert governor_.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_limit_never_below_minimum():
+    async def run():
+        governor_ = governor(initial_limit=2, min_limit=2)
+        async with governor_.slot() as call:
+            call.ok = False
+        assert governor_.limit == 2
+
+    asyncio.run(run())
+
+
+def test_success_grows_limit_additively():
+    async def run():
+        governor_ = governor(initial_limit=4, max_limit=5)
+        for _ in range(4):
+            async with governor_.slot():
+                pass
+        assert 4.9 < governor_.limit <= 5
+        for _ in range(10):
+            async with governor_.slot():
+                pass
+        assert governor_.limit == 5
+        assert governor_.stats()['requests'] == 14
+
+    asyncio.run(run())
+
+
+def test_concurrency_capped_by_limit():
+    async def run():
+        governor_ = governor(initial_limit=2)
+        peak = 0
+
+        async def call():
+            nonlocal peak
+            async with governor_.slot():
+                peak = max(peak, governor_.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(call() for _ in range(6)))
+        assert peak == 2
+
+    asyncio.run(run())
+
+
+def test_token_bucket_limits_rate():
+    async def run():
+        governor_ = governor(rate=50, burst=2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for _ in range(7):
+            async with governor_.slot():
+                pass
+        # two calls from the burst, five more at 50 per second
+        assert loop.time() - start >= 0.09
+        assert governor_.stats()['wait_time'] > 0
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+import pytest
+from app.utils.media import frames_length, part_count
+
+
+@pytest.mark.parametrize('length, parts', [
+    (1, 1), (60, 1), (61, 2), (119.5, 2), (120, 3), (181.032, 4), (360, 7),
+])
+def test_part_count(length, parts):
+    assert part_count(length) == parts
+
+
+def test_part_count_covers_audio():
+    # parts are a minute long and start every 59 seconds, a dropped last part is shorter than 2 seconds
+    for tenths in range(10, 7200):
+        length = tenths / 10
+        parts = part_count(length)
+        assert (parts - 1) * 59 + 60 >= length - 2
+        assert parts == 1 or length - (parts - 1) * 59 >= 2
+
+
+def test_frames_length(tmp_path):
+    frames = tmp_path / 'in.frames'
+    frames.write_text('#software: Lavf60.3.100\n'
+                      '#tb 0: 1/44100\n'
+                      '#media_type 0: audio\n'
+                      '#stream#, dts,        pts, duration,     size, hash\n'
+                      '0,          0,          0,   1048576,  4194304, 0x1\n'
+                      '0,    1048576,    1048576,    441000,  1764000, 0x2\n')
+    assert frames_length(frames) == pytest.approx(1489576 / 44100)
+
+
+def test_frames_length_empty(tmp_path):
+    frames = tmp_path / 'in.frames'
+    frames.write_text('#tb 0: 1/44100\n')
+    assert frames_length(frames) == 0
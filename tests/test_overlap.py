@@ -0,0 +1,36 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from app.utils.overlap import fade_in, merged_length, overlap_add, overlaps
+
+
+def test_fade_in_cubic_curve():
+    curve = fade_in(4)[:, 0]
+    assert curve.shape == (4,)
+    assert curve == pytest.approx([0, 1 / 64, 8 / 64, 27 / 64])
+    assert np.all(np.diff(fade_in(1000)[:, 0]) > 0)
+
+
+def test_overlaps_clipped_by_short_parts():
+    assert overlaps([10, 10, 3], 4) == [0, 4, 3]
+    assert overlaps([2, 10], 4) == [0, 2]
+    assert merged_length([10, 10, 3], 4) == 16
+
+
+def test_overlap_add_crossfades_into_next_part():
+    parts = [np.ones((10, 2), dtype=np.float32), np.full((10, 2), 2, dtype=np.float32)]
+    out = np.zeros((merged_length([10, 10], 4), 2), dtype=np.float32)
+    assert overlap_add(parts, 4, out) == 16
+    # the outgoing part is kept as it is, the incoming part fades in over it
+    assert out[:6, 0] == pytest.approx(np.ones(6))
+    assert out[6:10, 0] == pytest.approx(1 + 2 * fade_in(4)[:, 0])
+    assert out[10:, 0] == pytest.approx(np.full(6, 2))
+    assert np.array_equal(out[:, 0], out[:, 1])
+
+
+def test_overlap_add_single_part():
+    part = np.arange(6, dtype=np.float32)[:, None]
+    out = np.zeros((6, 1), dtype=np.float32)
+    assert overlap_add([part], 4, out) == 6
+    assert np.array_equal(out, part)